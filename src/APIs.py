@@ -3,44 +3,94 @@
 # Topic:    Definition of the REST APIs which can be used to
 #           communicate with the processing server
 
+import bisect
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import numpy as np
-from EncoderDecoder import EncoderDecoderNumpy, EncoderDecoderImage
+from EncoderDecoder import EncoderDecoderNumpy, EncoderDecoderImage, \
+                           EncoderDecoderNumpyBinary
 import requests
-from Utilities import print_execution_time
+from Utilities import print_execution_time, DequantizeEmbeddings
 
 class RESTAPIs_v1():
 
-    def __init__(self, url) -> None:
+    def __init__(self, url, checkServer = True, timeout : float = None) -> None:
         '''Initialize REST API interface'''
         self.url = url
         self.version = 'v1.0'
-        self.GetServerInformation()
+        self.timeout = timeout
+        # Sessions keep connections alive, one for each thread since they
+        # are not thread safe
+        self._sessions = threading.local()
+        if checkServer:
+            self.GetServerInformation()
         return
 
+    def _GetSession(self) -> requests.Session:
+        if not hasattr(self._sessions, 'session'):
+            self._sessions.session = requests.Session()
+        return self._sessions.session
+
     def GetServerInformation(self) -> bool:
         '''Send status request to server and check availability'''
         print('Getting server information...')
-        resultJson = requests.get(url=self.url).json()
+        resultJson = self._GetSession().get(url=self.url, timeout=self.timeout).json()
         print(resultJson)
         assert resultJson['running'] == True
         assert self.version in resultJson['supportedAPIs']
-        return
+        return True
 
     @print_execution_time
-    def DetectObjects(self, image : np.array):
-        '''Detect objects on the image using FasterRCNN model'''
-        # Create API request
+    def DetectObjects(self, image : np.array, latencyBudgetMs : float = None,
+                      minScore : float = None, embeddingsType : str = None,
+                      tileSize : int = None, tileOverlap : int = None):
+        '''Detect objects on the image using FasterRCNN model. If a latency
+        budget is given, the server uses the most accurate model variant
+        expected to respond within it. If embeddingsType ('float16' or
+        'int8') is given, the appearance embedding of each box is also
+        requested, when supported by the server backend. If tileSize is
+        given, a high resolution image is detected in overlapping tiles of
+        that size, instead of being downscaled by the model'''
+        requestJson = self.CreateDetectObjectsRequest(
+            image, latencyBudgetMs, minScore, embeddingsType,
+            tileSize, tileOverlap)
+        return self.PostDetectObjectsRequest(requestJson)
+
+    def CreateDetectObjectsRequest(self, image : np.array,
+                                   latencyBudgetMs : float = None,
+                                   minScore : float = None,
+                                   embeddingsType : str = None,
+                                   tileSize : int = None,
+                                   tileOverlap : int = None) -> dict:
+        '''Create API request, which can be sent to any server'''
         enc = EncoderDecoderImage().Encode(image, np.uint8)
         requestJson = {
             'image': enc
         }
+        if latencyBudgetMs is not None:
+            requestJson['latencyBudgetMs'] = latencyBudgetMs
+        if minScore is not None:
+            requestJson['minScore'] = minScore
+        if embeddingsType is not None:
+            requestJson['embeddings'] = embeddingsType
+        if tileSize is not None:
+            requestJson['tileSize'] = tileSize
+        if tileOverlap is not None:
+            requestJson['tileOverlap'] = tileOverlap
+        return requestJson
 
-        # Call API with request and get results
+    def PostDetectObjectsRequest(self, requestJson : dict) -> list:
+        '''Call API with request and get results'''
         print('Performing REST API call...')
-        resultJson = requests.post(
+        response = self._GetSession().post(
                     self.url + "/api/v1.0/detectobjects",
-                    json = requestJson
-                ).json()
+                    json = requestJson,
+                    timeout = self.timeout
+                )
+        response.raise_for_status()
+        resultJson = response.json()
         print('Response acquired')
 
         # Format results
@@ -51,4 +101,208 @@ class RESTAPIs_v1():
                 'labels': EncoderDecoderNumpy().Decode(p['labels'], np.float32),
                 'scores': EncoderDecoderNumpy().Decode(p['scores'], np.float32)
             })
+            if 'embeddings' in p:
+                prediction[-1]['embeddings'] = DequantizeEmbeddings(
+                    EncoderDecoderNumpyBinary().Decode(p['embeddings'], np.float32))
         return prediction
+
+
+class ServerNode():
+    '''Server of a pool, with its health and load status'''
+
+    def __init__(self, url : str, timeout : float) -> None:
+        self.url = url
+        self.api = RESTAPIs_v1(url, checkServer=False, timeout=timeout)
+        self.isHealthy = False
+        self.numOutstanding = 0
+        self.latencyMs = None   # exponentially weighted moving average
+
+    def AddLatencySample(self, latencyMs : float, smoothing = 0.2) -> None:
+        if self.latencyMs is None:
+            self.latencyMs = latencyMs
+        else:
+            self.latencyMs += smoothing * (latencyMs - self.latencyMs)
+
+
+class RESTAPIsPool_v1():
+    '''REST API interface to a pool of servers. Requests are spread by least
+    outstanding requests or, when a stream ID is given and the policy is
+    'consistent-hash', always sent to the same server of the stream (e.g.
+    when the server keeps state of the stream). Server health is probed
+    in background, failed requests are retried on another server and slow
+    requests are hedged on another server'''
+
+    def __init__(self, urls : list, policy = 'least-outstanding',
+                 healthCheckInterval = 1.0, timeout = 5.0, maxRetries = 2,
+                 hedgeFactor = 3.0, numVirtualNodes = 64,
+                 healthCheckTimeout = 1.0) -> None:
+        '''A request is hedged when it takes longer than hedgeFactor times
+        the average latency of its server; None disables hedging. A server
+        not answering a health probe within healthCheckTimeout seconds is
+        marked unhealthy'''
+        assert policy in ('least-outstanding', 'consistent-hash')
+        self.version = 'v1.0'
+        self._policy = policy
+        self._healthCheckInterval = healthCheckInterval
+        self._healthCheckTimeout = healthCheckTimeout
+        self._timeout = timeout
+        self._maxRetries = maxRetries
+        self._hedgeFactor = hedgeFactor
+        self._nodes = [ServerNode(url, timeout) for url in urls]
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=4 * len(urls))
+
+        # Hash ring with virtual nodes, for consistent hashing of streams
+        self._ring = sorted(
+            (self._Hash(url + '#' + str(i)), idx)
+            for idx, url in enumerate(urls) for i in range(numVirtualNodes)
+        )
+        self._ringKeys = [h for h, _ in self._ring]
+
+        # Probe all servers once before starting
+        list(self._executor.map(self.CheckHealth, self._nodes))
+        self._isRunning = True
+        threading.Thread(target=self._HealthCheckLoop, daemon=True).start()
+        return
+
+    @staticmethod
+    def _Hash(key : str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def CheckHealth(self, node : ServerNode) -> bool:
+        '''Send status request to server and update its availability'''
+        try:
+            resultJson = requests.get(
+                url=node.url, timeout=self._healthCheckTimeout).json()
+            isHealthy = resultJson['running'] == True and \
+                self.version in resultJson['supportedAPIs']
+        except (requests.RequestException, ValueError, KeyError):
+            isHealthy = False
+        if isHealthy != node.isHealthy:
+            print('Server', node.url, 'is', 'healthy' if isHealthy else 'unhealthy')
+        node.isHealthy = isHealthy
+        return isHealthy
+
+    def _HealthCheckLoop(self) -> None:
+        while self._isRunning:
+            time.sleep(self._healthCheckInterval)
+            # Probed in parallel, so that a server not answering does not
+            # delay the health update of the others
+            try:
+                list(self._executor.map(self.CheckHealth, self._nodes))
+            except RuntimeError:
+                # Executor shut down by Close
+                break
+
+    def GetHealthyNodes(self) -> list:
+        healthy = [n for n in self._nodes if n.isHealthy]
+        # If none is known to be healthy, try them all anyway
+        return healthy if healthy else list(self._nodes)
+
+    def SelectNode(self, streamID = None, exclude = ()) -> ServerNode:
+        '''Select the server for a request, excluding those already tried'''
+        candidates = [n for n in self.GetHealthyNodes() if n not in exclude]
+        if not candidates:
+            candidates = [n for n in self._nodes if n not in exclude]
+        if not candidates:
+            return None
+        if self._policy == 'consistent-hash' and streamID is not None:
+            # First candidate clockwise on the ring from the stream hash
+            start = bisect.bisect(self._ringKeys, self._Hash(str(streamID)))
+            for i in range(len(self._ring)):
+                node = self._nodes[self._ring[(start + i) % len(self._ring)][1]]
+                if node in candidates:
+                    return node
+        # Ties are broken by the fastest server, unmeasured ones first
+        with self._lock:
+            return min(candidates, key=lambda n: (n.numOutstanding, n.latencyMs or 0.0))
+
+    @staticmethod
+    def IsServerFailure(error : requests.RequestException) -> bool:
+        '''Connection errors, timeouts and server errors (5xx) are failures
+        of the server. Other errors (e.g. 4xx) are caused by the request
+        and would fail on any server'''
+        if isinstance(error, requests.HTTPError):
+            return error.response is not None and error.response.status_code >= 500
+        return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+    def _Post(self, node : ServerNode, requestJson : dict) -> list:
+        with self._lock:
+            node.numOutstanding += 1
+        try:
+            start = time.perf_counter()
+            prediction = node.api.PostDetectObjectsRequest(requestJson)
+            with self._lock:
+                node.AddLatencySample((time.perf_counter() - start) * 1e3)
+            return prediction
+        except requests.RequestException as e:
+            if self.IsServerFailure(e):
+                node.isHealthy = False
+            raise
+        finally:
+            with self._lock:
+                node.numOutstanding -= 1
+
+    def _GetHedgeDelay(self, node : ServerNode, streamID) -> float:
+        # Hedging would move a consistently hashed stream to another server
+        if self._hedgeFactor is None or node.latencyMs is None or \
+                (self._policy == 'consistent-hash' and streamID is not None):
+            return None
+        return self._hedgeFactor * node.latencyMs / 1e3
+
+    @print_execution_time
+    def DetectObjects(self, image : np.array, latencyBudgetMs : float = None,
+                      minScore : float = None, embeddingsType : str = None,
+                      tileSize : int = None, tileOverlap : int = None,
+                      streamID = None):
+        '''Detect objects on the image using FasterRCNN model, on one of the
+        servers of the pool'''
+        requestJson = self._nodes[0].api.CreateDetectObjectsRequest(
+            image, latencyBudgetMs, minScore, embeddingsType,
+            tileSize, tileOverlap)
+
+        tried = []
+        inFlight = {}
+        lastError = None
+        while True:
+            if not inFlight:
+                if len(tried) > self._maxRetries:
+                    break
+                node = self.SelectNode(streamID, exclude=tried)
+                if node is None:
+                    break
+                tried.append(node)
+                inFlight[self._executor.submit(self._Post, node, requestJson)] = node
+
+            primary = next(iter(inFlight.values()))
+            hedgeDelay = self._GetHedgeDelay(primary, streamID) \
+                if len(inFlight) == 1 else None
+            done, _ = wait(inFlight, timeout=hedgeDelay, return_when=FIRST_COMPLETED)
+
+            if not done:
+                # Slow request, hedge it on another server
+                node = self.SelectNode(streamID, exclude=tried)
+                if node is None or len(tried) > self._maxRetries:
+                    done, _ = wait(inFlight, return_when=FIRST_COMPLETED)
+                else:
+                    print('Hedging request on', node.url)
+                    tried.append(node)
+                    inFlight[self._executor.submit(self._Post, node, requestJson)] = node
+                    continue
+
+            for future in done:
+                node = inFlight.pop(future)
+                try:
+                    return future.result()
+                except requests.RequestException as e:
+                    print('Request to', node.url, 'failed:', e)
+                    if not self.IsServerFailure(e):
+                        # Not retried, the request is invalid
+                        raise
+                    lastError = e
+
+        raise ConnectionError('All servers failed') from lastError
+
+    def Close(self) -> None:
+        self._isRunning = False
+        self._executor.shutdown(wait=False)
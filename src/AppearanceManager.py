@@ -0,0 +1,178 @@
+# Date:     2026-10-19
+# Author:   Massimo Clementi <massimo_clementi@icloud.com>
+# Topic:    Per-frame budget of appearance (ORB features) extraction and
+#           matching for the multiobject tracker. Only detections whose
+#           association is not already decided by geometry, new objects and
+#           tracks with a stale template get their features extracted, most
+#           ambiguous first, and only pairs of detection and track which are
+#           close enough to be associated get their features matched
+
+import time
+import numpy as np
+from scipy.spatial import distance_matrix
+import BoundingBox
+from FeatureExtractors import FeatureExtractor, FeatureExtractorORB
+from FeatureMatchers import FeatureMatcherORB
+from TrackStore import TrackStore
+
+
+class AppearanceManager():
+
+    # Extraction priorities, lower is extracted first
+    _AMBIGUOUS = 0
+    _NEW_MATCH = 1
+    _REFRESH = 2
+    _SKIP = 3
+
+    # Share of the time budget that extraction can use, the rest is left to
+    # matching the extracted features
+    _extractionShare = 0.5
+
+    def __init__(self, budgetMs : float = None, budgetKeypoints : int = None,
+                 refreshInterval = 10) -> None:
+        '''Extraction and matching of features in a frame take at most
+        budgetMs milliseconds, and extraction stops once budgetKeypoints
+        keypoints have been computed (None means no limit). The template of
+        a track is refreshed by a correspondent detection every
+        refreshInterval frames'''
+        self._budgetMs = budgetMs
+        self._budgetKeypoints = budgetKeypoints
+        self._refreshInterval = refreshInterval
+        self.StartFrame()
+
+    def GetSettings(self) -> dict:
+        '''Settings that the tracker needs to replay the detections of a log
+        recorded with this manager. The budget is not included, as replayed
+        detections already have features only where they were extracted'''
+        return {'refreshInterval': self._refreshInterval}
+
+    def StartFrame(self) -> None:
+        '''Start accounting the budget of a new frame'''
+        self._frameStart = time.perf_counter()
+
+    def _IsOverTimeBudget(self, share = 1.0) -> bool:
+        return self._budgetMs is not None and \
+            (time.perf_counter() - self._frameStart) * 1e3 >= share * self._budgetMs
+
+    def IsTemplateDue(self, tracks : TrackStore, idx : int) -> bool:
+        return tracks.templateAges[idx] >= self._refreshInterval or \
+            not tracks.features[idx].isSuccessful
+
+    def GetPriorities(self, dBoxes : np.ndarray, dLabels : np.ndarray,
+                      tracks : TrackStore, tPredictedBoxes : np.ndarray,
+                      correspondenceMaxDistance : float,
+                      occlusionMinDistance : float) -> tuple:
+        '''Classify each detection on geometry alone, in the same way of the
+        tracker, and get its extraction priority and the order within it'''
+        priorities = np.full(len(dBoxes), self._SKIP)
+        order = np.zeros(len(dBoxes))
+        if len(dBoxes) == 0:
+            return priorities, order
+
+        dCenters = np.apply_along_axis(BoundingBox.GetCenter, 1, dBoxes)
+        for l in np.unique(dLabels):
+            dIndexes = np.flatnonzero(dLabels == l)
+            tIndexes = np.flatnonzero(np.logical_and(
+                tracks.labels == l, tracks.lives > 0))
+            if len(tIndexes) == 0:
+                priorities[dIndexes] = self._NEW_MATCH
+                continue
+
+            tCenters = np.apply_along_axis(
+                BoundingBox.GetCenter, 1, tPredictedBoxes[tIndexes])
+            distances = distance_matrix(dCenters[dIndexes], tCenters)
+            sortedIndexes = np.argsort(distances, axis=1)
+            for i, dIdx in enumerate(dIndexes):
+                minValue = distances[i, sortedIndexes[i, 0]]
+                gap = distances[i, sortedIndexes[i, 1]] - minValue \
+                    if len(tIndexes) > 1 else 1e9
+                tIdx = tIndexes[sortedIndexes[i, 0]]
+                if minValue >= correspondenceMaxDistance:
+                    priorities[dIdx] = self._NEW_MATCH
+                elif gap <= occlusionMinDistance:
+                    # Smallest margin is the most ambiguous
+                    priorities[dIdx] = self._AMBIGUOUS
+                    order[dIdx] = gap
+                elif self.IsTemplateDue(tracks, tIdx):
+                    # Oldest template first
+                    priorities[dIdx] = self._REFRESH
+                    order[dIdx] = -tracks.templateAges[tIdx]
+        return priorities, order
+
+    def ExtractFeatures(self, image : np.ndarray, dBoxes : np.ndarray,
+                        dLabels : np.ndarray, tracks : TrackStore,
+                        tPredictedBoxes : np.ndarray,
+                        correspondenceMaxDistance : float,
+                        occlusionMinDistance : float) -> np.ndarray:
+        '''Extract features of the selected detections within the budget.
+        Skipped detections get empty features, for which the tracker falls
+        back to geometry only'''
+        priorities, order = self.GetPriorities(
+            dBoxes, dLabels, tracks, tPredictedBoxes,
+            correspondenceMaxDistance, occlusionMinDistance)
+
+        features = np.ndarray(len(dBoxes), dtype=FeatureExtractor)
+        for i in range(len(dBoxes)):
+            features[i] = FeatureExtractorORB()
+            features[i].SetFeatures(None)
+
+        numKeypoints = 0
+        numExtracted = 0
+        candidates = np.flatnonzero(priorities != self._SKIP)
+        for i in candidates[np.lexsort((order[candidates], priorities[candidates]))]:
+            if self._IsOverTimeBudget(self._extractionShare):
+                break
+            if self._budgetKeypoints is not None and \
+                    numKeypoints >= self._budgetKeypoints:
+                break
+            patch = BoundingBox.GetImagePatch(dBoxes[i], image)
+            features[i].ComputeFeatures(patch)
+            numKeypoints += len(features[i].GetFeatures()[0])
+            numExtracted += 1
+
+        print('Extracted features of', numExtracted, 'of', len(dBoxes),
+              'detections,', len(candidates) - numExtracted, 'skipped over budget')
+        return features
+
+    def ComputeFeatureDiffMatrix(self, dFeatures : np.ndarray,
+                                 tFeatures : np.ndarray,
+                                 centersDistances : np.ndarray,
+                                 maxDistance : float) -> np.ndarray:
+        '''Get feature distances between detections and tracks. Each row
+        (detection) is either compared by features or, if any of its pairs
+        closer than maxDistance can not be matched (missing features or no
+        time budget left), by geometry only, i.e. by center distances, so
+        that costs in a row are never mixed. In rows compared by features,
+        only pairs closer than maxDistance are matched, the others can not
+        be associated. Rows are matched by increasing distance of their
+        closest pair, within the time budget of the frame'''
+        featureDiffMatrix = np.array(centersDistances, dtype=float)
+        dHasFeatures = np.array([f.isSuccessful for f in dFeatures], dtype=bool)
+        tHasFeatures = np.array([f.isSuccessful for f in tFeatures], dtype=bool)
+        isCandidate = centersDistances < maxDistance
+        rows = [i for i in range(len(dFeatures))
+                if dHasFeatures[i] and isCandidate[i].any() and
+                tHasFeatures[isCandidate[i]].all()]
+        rows.sort(key=lambda i: np.min(centersDistances[i][isCandidate[i]]))
+
+        numMatched = 0
+        featureMatcher = FeatureMatcherORB()
+        for i in rows:
+            rowDiff = np.full(len(tFeatures), 1e9)
+            for j in np.flatnonzero(isCandidate[i]):
+                if self._IsOverTimeBudget():
+                    break
+                featureMatcher.ComputeMatchingFeatures(dFeatures[i], tFeatures[j])
+                rowDiff[j] = featureMatcher.GetMatchingLoss()
+            else:
+                featureDiffMatrix[i] = rowDiff
+                numMatched += 1
+                continue
+            # Out of budget, this and the remaining rows keep geometry
+            break
+
+        if numMatched < len(rows):
+            print('Matched features of', numMatched, 'of', len(rows),
+                  'candidate detections,', len(rows) - numMatched,
+                  'skipped over budget')
+        return featureDiffMatrix
@@ -0,0 +1,72 @@
+# Date:     2026-10-19
+# Author:   Massimo Clementi <massimo_clementi@icloud.com>
+# Topic:    Compare latency of the available inference backends on the same
+#           input images
+
+import argparse
+import json
+import time
+import cv2
+import numpy as np
+from CoreEngine import MyObjectDetector
+from InferenceBackends import GetAvailableBackends
+
+
+def BenchmarkBackend(backend : str, precision : str, images : np.ndarray,
+                     numWarmup : int, numIterations : int) -> dict:
+    detector = MyObjectDetector(backend=backend, precision=precision)
+
+    start = time.perf_counter()
+    detector.CreateDNNModel()
+    loadTime = time.perf_counter() - start
+
+    for _ in range(numWarmup):
+        detector.Detect(images, minScore=0.8)
+
+    latencies = []
+    for _ in range(numIterations):
+        start = time.perf_counter()
+        detector.Detect(images, minScore=0.8)
+        latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies) * 1e3
+
+    return {
+        'backend': detector.backend.name,
+        'precision': precision,
+        'batchShape': list(images.shape),
+        'loadMs': loadTime * 1e3,
+        'meanMs': float(np.mean(latencies)),
+        'p50Ms': float(np.percentile(latencies, 50)),
+        'p95Ms': float(np.percentile(latencies, 95)),
+        'minMs': float(np.min(latencies))
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the available inference backends')
+    parser.add_argument('--image', default='../images/test-1.jpg')
+    parser.add_argument('--backends', default=','.join(
+                            b for b in GetAvailableBackends() if b != 'stub'),
+                        help='comma separated backend names')
+    parser.add_argument('--precision', default='float32')
+    parser.add_argument('--batchSize', type=int, default=1)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--output', default=None,
+                        help='write results as JSON to this path')
+    args = parser.parse_args()
+
+    image = cv2.imread(args.image)
+    assert image is not None, 'Cannot read image ' + args.image
+    images = np.array([image] * args.batchSize)
+
+    results = [
+        BenchmarkBackend(b, args.precision, images, args.warmup, args.iterations)
+        for b in args.backends.split(',')
+    ]
+
+    print(json.dumps(results, indent=2))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
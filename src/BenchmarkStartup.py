@@ -0,0 +1,109 @@
+# Date:     2026-10-19
+# Author:   Massimo Clementi <massimo_clementi@icloud.com>
+# Topic:    Measure cold start time and peak memory of client and server.
+#           Each measurement runs in a fresh Python process, so that module
+#           caches and already mapped pages do not affect the results
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+
+
+def GetPeakMemoryMB() -> float:
+    # On Linux ru_maxrss is expressed in kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def MeasureClientStartup() -> dict:
+    '''Import everything the client needs'''
+    start = time.perf_counter()
+    import APIs
+    import Visualization
+    import MultiObjectTracker
+    import Framegrabber
+    importTime = time.perf_counter() - start
+    return {
+        'importMs': importTime * 1e3,
+        'torchImported': 'torch' in sys.modules,
+        'peakMemoryMB': GetPeakMemoryMB()
+    }
+
+def MeasureServerStartup(backend : str, precision : str) -> dict:
+    '''Import the core engine, create the model and run a first inference'''
+    start = time.perf_counter()
+    from CoreEngine import MyObjectDetector
+    importTime = time.perf_counter() - start
+
+    detector = MyObjectDetector(backend=backend, precision=precision)
+    start = time.perf_counter()
+    detector.CreateDNNModel()
+    createTime = time.perf_counter() - start
+
+    image = np.zeros((1, 480, 640, 3), dtype=np.uint8)
+    start = time.perf_counter()
+    detector.Detect(image, minScore=0.8)
+    firstDetectTime = time.perf_counter() - start
+
+    return {
+        'importMs': importTime * 1e3,
+        'createModelMs': createTime * 1e3,
+        'firstDetectMs': firstDetectTime * 1e3,
+        'totalMs': (importTime + createTime + firstDetectTime) * 1e3,
+        'peakMemoryMB': GetPeakMemoryMB()
+    }
+
+def RunInFreshProcess(args : list) -> dict:
+    output = subprocess.run(
+        [sys.executable, __file__, '--child'] + args,
+        check=True, capture_output=True, text=True
+    ).stdout
+    # Result is the last line, after the logs of the measured code
+    return json.loads(output.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark cold start of client and server')
+    parser.add_argument('--target', choices=['client', 'server', 'all'],
+                        default='all')
+    parser.add_argument('--backend', default='eager')
+    parser.add_argument('--precision', default='float32')
+    parser.add_argument('--repetitions', type=int, default=3)
+    parser.add_argument('--output', default=None,
+                        help='write results as JSON to this path')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        if args.target == 'client':
+            result = MeasureClientStartup()
+        else:
+            result = MeasureServerStartup(args.backend, args.precision)
+        print(json.dumps(result))
+        sys.exit(0)
+
+    targets = ['client', 'server'] if args.target == 'all' else [args.target]
+    results = {}
+    for target in targets:
+        runs = [
+            RunInFreshProcess(['--target', target, '--backend', args.backend,
+                               '--precision', args.precision])
+            for _ in range(args.repetitions)
+        ]
+        # Report the median of each metric over the repetitions
+        results[target] = {
+            key: float(np.median([r[key] for r in runs])) if not isinstance(runs[0][key], bool)
+            else runs[0][key]
+            for key in runs[0]
+        }
+    if 'server' in results:
+        results['server']['backend'] = args.backend
+        results['server']['precision'] = args.precision
+
+    print(json.dumps(results, indent=2))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -26,4 +26,42 @@ def GetDelta(bboxB : np.ndarray, bboxA : np.ndarray):
 def GetImagePatch(box : np.ndarray, image : np.ndarray) -> np.ndarray:
     c1, r1, c2, r2 = np.asarray(box, dtype=int)
     patch = image[r1:r2,c1:c2,:]
-    return patch
\ No newline at end of file
+    return patch
+
+def NonMaximumSuppression(boxes : np.ndarray, scores : np.ndarray,
+                          labels : np.ndarray = None, threshold = 0.5,
+                          metric = 'iou', groups : np.ndarray = None) -> np.ndarray:
+    '''Greedy non maximum suppression. Get the indexes of the kept boxes,
+    by decreasing score. The overlap is the intersection over union ('iou')
+    or over the area of the smaller box ('ios'), which also suppresses
+    boxes contained in others. If labels are given, only boxes of the same
+    label suppress each other. If groups are given (e.g. the tile of each
+    box), the metric only applies between boxes of different groups, while
+    boxes of the same group are compared by intersection over union'''
+    assert metric in ('iou', 'ios')
+    areas = np.maximum(0, boxes[:, 2] - boxes[:, 0]) * \
+        np.maximum(0, boxes[:, 3] - boxes[:, 1])
+    order = np.argsort(-scores, kind='stable')
+    keep = []
+    while len(order) > 0:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        widths = np.minimum(boxes[i, 2], boxes[rest, 2]) - \
+            np.maximum(boxes[i, 0], boxes[rest, 0])
+        heights = np.minimum(boxes[i, 3], boxes[rest, 3]) - \
+            np.maximum(boxes[i, 1], boxes[rest, 1])
+        intersections = np.maximum(0, widths) * np.maximum(0, heights)
+        unions = areas[i] + areas[rest] - intersections
+        if metric == 'iou':
+            denominators = unions
+        else:
+            denominators = np.minimum(areas[i], areas[rest])
+            if groups is not None:
+                denominators = np.where(
+                    groups[rest] == groups[i], unions, denominators)
+        overlaps = intersections / np.maximum(denominators, 1e-9)
+        if labels is not None:
+            overlaps[labels[rest] != labels[i]] = 0
+        order = rest[overlaps <= threshold]
+    return np.array(keep, dtype=int)
@@ -6,8 +6,9 @@ import cv2
 import numpy as np
 from Framegrabber import Framegrabber
 import APIs
-import CoreEngine
+from Visualization import ResultsVisualizer
 from MultiObjectTracker import MultiObjectTracker
+from AppearanceManager import AppearanceManager
 from FeatureExtractors import FeatureExtractorORB
 from FeatureMatchers import FeatureMatcherORB
 
@@ -20,15 +21,41 @@ framegrabber.set_scaling_factor(0.50)
 framegrabber.set_sampling_interval(10)
 
 apis = APIs.RESTAPIs_v1('http://localhost:5000')
-objectDetector = CoreEngine.MyObjectDetector()
+# When running on the same host of the server, frames can be exchanged
+# through shared memory instead (server started with TRIP_SHM_PORT=6000 and
+# the same TRIP_SHM_AUTHKEY)
+# import os
+# from SharedMemoryTransport import SharedMemoryAPIs_v1
+# apis = SharedMemoryAPIs_v1(('127.0.0.1', 6000),
+#                            authkey=os.environ['TRIP_SHM_AUTHKEY'].encode('utf-8'))
+# Requests can also be spread over a pool of servers
+# apis = APIs.RESTAPIsPool_v1(['http://localhost:5000', 'http://localhost:5001'])
+
+# Use appearance embeddings computed by the server detector ('float16' or
+# 'int8'), instead of extracting ORB features on the client
+# embeddingsType = 'int8'
+embeddingsType = None
+resultsVisualizer = ResultsVisualizer()
+
+# Extract ORB features only where geometry is ambiguous, for new objects and
+# to refresh stale templates, within a per-frame budget
+appearanceManager = AppearanceManager(budgetMs=20, refreshInterval=10)
 
 multiObjectTracker = MultiObjectTracker(
     maxNumTrackedObjects=150,
     correspondenceMaxDistance=50,
     occlusionMinDistance=20,
-    distanceFeaturesWeightFactor=0.5
+    distanceFeaturesWeightFactor=0.5,
+    appearanceManager=appearanceManager
 )
 
+# Optionally record detections and tracker output, to be replayed offline
+# with ReplayTracker.py when tuning the tracker parameters
+# from DetectionLog import DetectionLogWriter
+# detectionLog = DetectionLogWriter(
+#     'detections.triplog', appearanceSettings=appearanceManager.GetSettings())
+detectionLog = None
+
 # Create visualization window(s)
 cv2.namedWindow('Output', cv2.WINDOW_NORMAL)
 
@@ -44,7 +71,7 @@ video = cv2.VideoWriter('output_video.mp4', fourcc, 25, (frame.shape[1], frame.s
 while not framegrabber.is_ended():
 
     #predictions = objectDetector.Detect(np.array([frame]), minScore=0.8)
-    predictions = apis.DetectObjects(frame)
+    predictions = apis.DetectObjects(frame, embeddingsType=embeddingsType)
     #print(predictions)
     #print(predictions[0]['boxes'].shape)
     #print(predictions[0]['labels'].shape)
@@ -52,12 +79,24 @@ while not framegrabber.is_ended():
     multiObjectTracker.Update(
         frame,
         predictions[0]['boxes'],
-        predictions[0]['labels']
+        predictions[0]['labels'],
+        dEmbeddings=predictions[0].get('embeddings')
     )
     trackedPredictions = multiObjectTracker.GetTrackedObjects(minLife=3)
 
-    #objectDetector.GetResultsOverlay(frame, frameCount, predictions[0])
-    objectDetector.GetResultsOverlay(frame, frameCount, trackedPredictions, useTrackingIDs=True)
+    if detectionLog is not None:
+        detectionLog.WriteFrame(
+            frameCount,
+            predictions[0]['boxes'],
+            predictions[0]['labels'],
+            predictions[0]['scores'],
+            features=multiObjectTracker.GetLastDetectedFeatures(),
+            trackedObjects=trackedPredictions,
+            embeddings=predictions[0].get('embeddings')
+        )
+
+    #resultsVisualizer.GetResultsOverlay(frame, frameCount, predictions[0])
+    resultsVisualizer.GetResultsOverlay(frame, frameCount, trackedPredictions, useTrackingIDs=True)
     cv2.imshow('Output', frame)
     video.write(frame)
     if cv2.waitKey(1) & 0xFF == ord('q'):
@@ -70,4 +109,6 @@ while not framegrabber.is_ended():
 # Release the capture and close all windows
 framegrabber.cap_release()
 video.release()
+if detectionLog is not None:
+    detectionLog.Close()
 
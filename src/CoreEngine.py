@@ -1,25 +1,41 @@
 # Date:     2024-01-18
 # Author:   Massimo Clementi <massimo_clementi@icloud.com>
-# Topic:    Core engine that defines the logic for performing all the
-#           required tasks, both elaboration and visualization
+# Topic:    Core engine that defines the logic for performing the
+#           elaboration tasks. Visualization is defined in Visualization.py
+#
+#           torch and torchvision are imported lazily, when the model is
+#           created, so that importing this module stays cheap
 
+import os
 import numpy as np
-import cv2
-import torch
-import torchvision
-from COCOLabels import COCOLabels_2017
-from Utilities import print_execution_time
+import BoundingBox
+from Utilities import print_execution_time, GetFileHash, QuantizeEmbeddings
 
 
 class MyObjectDetector():
-    def __init__(self) -> None:
-        '''Instantiate an object detector'''
+    def __init__(self, backend = 'eager', precision = 'float32',
+                 weightsPath = './config/fasterrcnn_mobilenet_v3_large_fpn-state-dict.pth',
+                 artifactsCacheDir = './config/cache',
+                 architecture = 'fasterrcnn_mobilenet_v3_large_fpn',
+                 minSize = None) -> None:
+        '''Instantiate an object detector. The architecture is the name of
+        a torchvision detection model; both mobilenet v3 variants share the
+        same weights and only differ in input resolution and proposals.
+        If given, minSize overrides the default resize of the model'''
         self.model = None
+        self.architecture = architecture
+        self.minSize = minSize
+        self.backend = None
+        self.backendName = backend
+        self.precision = precision
+        self.weightsPath = weightsPath
+        self.artifactsCacheDir = artifactsCacheDir
         self.isModelCreated = False
-        self.device = self.GetCUDADeviceOrCPU()
+        self.device = None
 
-    def GetCUDADeviceOrCPU(self) -> torch.device:
+    def GetCUDADeviceOrCPU(self) -> 'torch.device':
         '''Get device to use with pytorch'''
+        import torch
         # setting device on GPU if available, else CPU
         device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         print('Torch is using device:', device)
@@ -32,71 +48,154 @@ class MyObjectDetector():
         
     @print_execution_time
     def CreateDNNModel(self):
-        '''Create the deep learning model architecture'''
-        print('Creating DNN model...')
-        # model = detection.fasterrcnn_mobilenet_v3_large_320_fpn(pretrained=True, pretrained_backbone = True)
-        self.model = torchvision.models.detection.fasterrcnn_mobilenet_v3_large_fpn(
-            weights=None, weights_backbone=None
-        ).to(self.device)
-        self.LoadModelStateDict('./config/fasterrcnn_mobilenet_v3_large_fpn-state-dict.pth')
+        '''Create the inference backend running the deep learning model'''
+        from InferenceBackends import CreateInferenceBackend
+        print('Creating DNN model with', self.backendName, 'backend...')
+        if self.device is None:
+            self.device = self.GetCUDADeviceOrCPU()
+        self.backend = CreateInferenceBackend(
+            self.backendName, self.device, self.precision)
+        self.backend.Load(self.CreateEagerModel, self.GetArtifactPath())
         self.isModelCreated = True
         return
+
+    @print_execution_time
+    def CreateEagerModel(self) -> 'torch.nn.Module':
+        '''Create the deep learning model architecture and load weights'''
+        import torch
+        import torchvision
+        # The architecture is built on the meta device, without allocating
+        # nor initializing parameters, which are then assigned directly from
+        # the memory-mapped weights file
+        kwargs = {}
+        if self.minSize is not None:
+            kwargs['min_size'] = self.minSize
+        with torch.device('meta'):
+            self.model = getattr(torchvision.models.detection, self.architecture)(
+                weights=None, weights_backbone=None, **kwargs
+            )
+        self.LoadModelStateDict(self.weightsPath)
+        self.model = self.model.to(self.device)
+        return self.model
+
+    def GetArtifactPath(self) -> str:
+        '''Get path of the exported model in the cache, keyed by weights
+        hash, precision, device and torch version'''
+        import torch
+        if self.backend.artifactExtension is None: return None
+        key = '-'.join([
+            self.architecture,
+            str(self.minSize or 'default'),
+            GetFileHash(self.weightsPath)[:16],
+            self.precision,
+            self.device.type,
+            'torch' + torch.__version__.replace('+', '_')
+        ])
+        return os.path.join(self.artifactsCacheDir,
+                            key + self.backend.artifactExtension)
     
     def SaveModelStateDict(self, path : str):
         '''Save weights and status of neural network to disk'''
+        import torch
         print('Saving DNN state dict to ', path)
         torch.save(self.model.state_dict(), path)
         return
     
     @print_execution_time
     def LoadModelStateDict(self, path : str):
-        '''Load weights and status of neural network from disk'''
+        '''Load weights and status of neural network from disk. Weights are
+        memory-mapped and assigned to the model, so that they are paged in
+        on demand instead of being read and copied at once'''
+        import torch
         print('Loading DNN state dict to ', path)
-        self.model.load_state_dict(torch.load(path))
+        stateDict = torch.load(path, map_location='cpu', mmap=True,
+                               weights_only=True)
+        self.model.load_state_dict(stateDict, assign=True)
         return
 
     @print_execution_time
-    def Detect(self, images : np.array, minScore : float) -> list:
-        '''Detect objects in the image'''
+    def Detect(self, images : np.array, minScore : float,
+               embeddingsType : str = None) -> list:
+        '''Detect objects in the image. If embeddingsType ('float16' or
+        'int8') is given and supported by the backend, an appearance
+        embedding of each box, quantized to that type, is also returned'''
         if(not self.isModelCreated): self.CreateDNNModel()
+
+        withEmbeddings = embeddingsType is not None
+        if withEmbeddings and not self.backend.supportsEmbeddings:
+            print('Backend', self.backend.name, 'does not support embeddings')
+            withEmbeddings = False
         
         print('Performing inference on provided samples...')
-        self.model.eval()
-        x = torch.tensor(
-            np.transpose(np.array(images/255, dtype=float), (0, 3, 1, 2))).to(self.device)
-        with torch.no_grad():
-            predictions = self.model.double()(x.double())
-
-        print('Selecting matches by score...')
-        for p in predictions:
-            scores = p['scores']
-            mask = scores > minScore
-            p['boxes'] = p['boxes'][mask].detach().cpu().numpy()
-            p['labels'] = p['labels'][mask].detach().cpu().numpy()
-            p['scores'] = p['scores'][mask].detach().cpu().numpy()
+        predictions = self.backend.Detect(images, minScore, withEmbeddings)
+        if withEmbeddings:
+            for p in predictions:
+                p['embeddings'] = QuantizeEmbeddings(p['embeddings'], embeddingsType)
         print(predictions)
 
         return predictions
-    
+
     @print_execution_time
-    def GetResultsOverlay(self, image : np.array, frameCount : int, predictions : dict, useTrackingIDs = False) -> np.array:
-        '''Display object detection results as overlay'''
-        display_color = (0, 255, 0)
-        for i in range(len(predictions['boxes'])):
-            label = predictions['labels'][i]
-            c1, r1, c2, r2 = map(int, predictions['boxes'][i].tolist())
-            image = cv2.rectangle(image, (c1, r1), (c2, r2), display_color, 3)
-            dispText = COCOLabels_2017().GetLabel(label)
-            if(useTrackingIDs):
-                id = predictions['ids'][i]
-                dispText += " | id " + str(id)
-            cv2.putText(image, dispText, 
-                        (c1 + 5, r1 + 15), cv2.FONT_HERSHEY_SIMPLEX, 0.75, 
-                        display_color, 2)
-        
-        # Finally, display frame count
-        cv2.putText(image, 'Frame count: {0:07d}'.format(frameCount), 
-            (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.75, 
-             display_color, 2)
-        return
-  
+    def DetectTiled(self, image : np.ndarray, minScore : float,
+                    tileSize = 800, overlap = 128, batchSize = 4,
+                    nmsThreshold = 0.5, embeddingsType : str = None) -> list:
+        '''Detect objects in a single high resolution image (H, W, 3), which
+        is split in overlapping tiles of tileSize pixels, detected in
+        batches of batchSize tiles. Peak memory is bounded by tile size and
+        batch size instead of image size, and objects keep their full
+        resolution. Boxes of the same object found in different tiles are
+        merged by NMS, while boxes within a tile are kept as detected;
+        objects larger than the overlap may be cut at tile seams. The result is a
+        list with one prediction, as for Detect'''
+        h, w = image.shape[:2]
+        tileH, tileW = min(tileSize, h), min(tileSize, w)
+        origins = [(r, c) for r in GetTileOrigins(h, tileSize, overlap)
+                          for c in GetTileOrigins(w, tileSize, overlap)]
+        print('Detecting on', len(origins), 'tiles of', tileW, 'x', tileH, '...')
+
+        parts = []
+        tileIndexes = []
+        for b in range(0, len(origins), batchSize):
+            batchOrigins = origins[b:b + batchSize]
+            # Only the tiles of one batch are copied at a time
+            batch = np.stack([image[r:r + tileH, c:c + tileW]
+                              for r, c in batchOrigins])
+            predictions = self.Detect(batch, minScore, embeddingsType)
+            for (r, c), p in zip(batchOrigins, predictions):
+                boxes = p['boxes']
+                # Boxes touching a tile border which is not an image border
+                # are likely cut by the seam
+                p['isCut'] = (boxes[:, 0] <= 1) & (c > 0) | \
+                    (boxes[:, 1] <= 1) & (r > 0) | \
+                    (boxes[:, 2] >= tileW - 1) & (c + tileW < w) | \
+                    (boxes[:, 3] >= tileH - 1) & (r + tileH < h)
+                p['boxes'] = boxes + np.array([c, r, c, r], dtype=boxes.dtype)
+                parts.append(p)
+                tileIndexes.append(np.full(len(boxes), len(tileIndexes)))
+
+        merged = {key: np.concatenate([p[key] for p in parts])
+                  for key in parts[0]}
+        # Duplicates across tiles are found by intersection over the smaller
+        # box, since the copy in one tile may be cut by its border. Cut boxes
+        # are ranked after all whole ones, so that the whole box of an
+        # object found in more tiles is kept. Boxes of the same tile were
+        # already suppressed by the model, by intersection over union
+        keep = BoundingBox.NonMaximumSuppression(
+            merged['boxes'], merged['scores'] - merged['isCut'],
+            merged['labels'], nmsThreshold, metric='ios',
+            groups=np.concatenate(tileIndexes))
+        del merged['isCut']
+        return [{key: merged[key][keep] for key in merged}]
+
+
+def GetTileOrigins(length : int, tileSize : int, overlap : int) -> list:
+    '''Get the origins of tiles of tileSize covering length, overlapping
+    by at least overlap. The last tile is shifted back to end at the image
+    border, so that all tiles have the same size'''
+    if length <= tileSize: return [0]
+    assert overlap < tileSize
+    stride = tileSize - overlap
+    numTiles = int(np.ceil((length - tileSize) / stride)) + 1
+    origins = [i * stride for i in range(numTiles)]
+    origins[-1] = length - tileSize
+    return origins
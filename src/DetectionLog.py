@@ -0,0 +1,271 @@
+# Date:     2026-10-19
+# Author:   Massimo Clementi <massimo_clementi@icloud.com>
+# Topic:    Compact columnar log of per-frame detections and tracker output.
+#           The log is written once while running the real detector and then
+#           memory-mapped for replay, so that the tracker can be tuned
+#           without any model in the loop.
+#
+#           File layout (little endian):
+#           [column 0][column 1]...[column N][JSON footer][footer size][magic]
+#           Each column is a raw contiguous array, aligned to 64 bytes. The
+#           JSON footer stores offset, dtype and shape of every column.
+
+import json
+import os
+import shutil
+import numpy as np
+
+_MAGIC = b'TRIPLOG1'
+_ALIGNMENT = 64
+_DESCRIPTOR_SIZE = 32   # ORB descriptors are 32 bytes each
+
+# Name and dtype of every column, with the number of values per row. The
+# width of embeddings is given by the detector, thus known on first write
+_COLUMNS = {
+    'frame_numbers':    (np.int64, 1),
+    'det_offsets':      (np.int64, 1),
+    'trk_offsets':      (np.int64, 1),
+    'det_boxes':        (np.float32, 4),
+    'det_labels':       (np.int32, 1),
+    'det_scores':       (np.float32, 1),
+    'desc_offsets':     (np.int64, 1),
+    'descriptors':      (np.uint8, _DESCRIPTOR_SIZE),
+    'det_embeddings':   (np.float16, None),
+    'trk_boxes':        (np.float32, 4),
+    'trk_labels':       (np.int32, 1),
+    'trk_ids':          (np.int64, 1),
+}
+
+
+class DetectionLogWriter():
+    '''Stream per-frame detections and tracker output to a columnar log.
+    Each column is spilled to its own temporary file while recording, so
+    memory usage does not grow with the length of the video; the columns
+    are concatenated into the final file by Close()'''
+
+    def __init__(self, path : str, storeDescriptors = True,
+                 appearanceSettings : dict = None) -> None:
+        '''Appearance settings, if provided, are those of the appearance
+        manager of the tracker (see AppearanceManager.GetSettings), stored
+        in the footer so that the log is replayed with the same ones'''
+        print('Opening detection log', path, 'for writing...')
+        self._path = path
+        self._storeDescriptors = storeDescriptors
+        self._appearanceSettings = appearanceSettings
+        self._spillDir = path + '.parts'
+        os.makedirs(self._spillDir, exist_ok=True)
+        self._spills = {
+            name: open(os.path.join(self._spillDir, name), 'wb')
+            for name in _COLUMNS
+        }
+        self._numFrames = 0
+        self._numDetections = 0
+        self._numTracks = 0
+        self._numDescriptors = 0
+        self._embeddingSize = None
+        self._numEmbeddings = 0
+        self._isClosed = False
+
+        # Offsets columns have one leading zero, so that the rows of frame i
+        # are always in the range [offsets[i], offsets[i+1])
+        for name in ('det_offsets', 'trk_offsets', 'desc_offsets'):
+            self._Append(name, np.zeros(1))
+
+    def _Append(self, name : str, data : np.ndarray) -> None:
+        dtype, _ = _COLUMNS[name]
+        self._spills[name].write(np.ascontiguousarray(data, dtype=dtype).tobytes())
+
+    def WriteFrame(self, frameNumber : int, boxes : np.ndarray,
+                   labels : np.ndarray, scores : np.ndarray,
+                   features : np.ndarray = None,
+                   trackedObjects : dict = None,
+                   embeddings : np.ndarray = None) -> None:
+        '''Append one frame. Features, if provided, are the ORB feature
+        extractors of each detection as computed by the tracker; embeddings,
+        if provided, are the detector appearance embeddings used by the
+        tracker instead. Either must be given in all frames when recording
+        descriptors, otherwise the replayed tracker has no appearance.
+        Tracked objects are in the format of
+        MultiObjectTracker.GetTrackedObjects'''
+        assert not self._isClosed
+        numDetections = len(boxes)
+        assert not self._storeDescriptors or features is not None or \
+            embeddings is not None, \
+            'Neither features nor embeddings of the detections are available'
+        # Embeddings are stored for all frames or for none
+        hasEmbeddings = embeddings is not None
+        if self._numFrames == 0 and hasEmbeddings:
+            self._embeddingSize = embeddings.shape[1]
+        assert hasEmbeddings == (self._embeddingSize is not None), \
+            'Embeddings must be given in all frames or in none'
+
+        self._Append('frame_numbers', np.array([frameNumber]))
+        self._Append('det_boxes', np.reshape(boxes, (numDetections, 4)))
+        self._Append('det_labels', labels)
+        self._Append('det_scores', scores)
+        self._numDetections += numDetections
+        self._Append('det_offsets', np.array([self._numDetections]))
+
+        # Descriptors have a variable number of rows per detection
+        if self._storeDescriptors:
+            assert features is None or len(features) == numDetections
+            for i in range(numDetections):
+                descriptors = None
+                if features is not None and features[i].isSuccessful:
+                    _, descriptors = features[i].GetFeatures()
+                if descriptors is not None:
+                    self._Append('descriptors', descriptors)
+                    self._numDescriptors += len(descriptors)
+                self._Append('desc_offsets', np.array([self._numDescriptors]))
+
+        if hasEmbeddings:
+            assert embeddings.shape == (numDetections, self._embeddingSize)
+            self._Append('det_embeddings', embeddings)
+            self._numEmbeddings += numDetections
+
+        if trackedObjects is not None:
+            numTracks = len(trackedObjects['boxes'])
+            self._Append('trk_boxes', np.reshape(trackedObjects['boxes'], (numTracks, 4)))
+            self._Append('trk_labels', trackedObjects['labels'])
+            self._Append('trk_ids', trackedObjects['ids'])
+            self._numTracks += numTracks
+        self._Append('trk_offsets', np.array([self._numTracks]))
+
+        self._numFrames += 1
+
+    def Close(self) -> None:
+        '''Concatenate the column spills into the final log file'''
+        if self._isClosed: return
+        print('Finalizing detection log with', self._numFrames, 'frames...')
+        for f in self._spills.values():
+            f.close()
+
+        numRows = {
+            'frame_numbers': self._numFrames,
+            'det_offsets': self._numFrames + 1,
+            'trk_offsets': self._numFrames + 1,
+            'det_boxes': self._numDetections,
+            'det_labels': self._numDetections,
+            'det_scores': self._numDetections,
+            'desc_offsets': self._numDetections + 1 if self._storeDescriptors else 1,
+            'descriptors': self._numDescriptors,
+            'det_embeddings': self._numEmbeddings,
+            'trk_boxes': self._numTracks,
+            'trk_labels': self._numTracks,
+            'trk_ids': self._numTracks,
+        }
+
+        widths = {'det_embeddings': self._embeddingSize or 0}
+        footer = {'version': 3, 'hasDescriptors': self._storeDescriptors,
+                  'hasEmbeddings': self._embeddingSize is not None,
+                  'appearanceSettings': self._appearanceSettings,
+                  'columns': {}}
+        with open(self._path, 'wb') as out:
+            for name, (dtype, width) in _COLUMNS.items():
+                width = widths.get(name, width)
+                out.write(b'\0' * (-out.tell() % _ALIGNMENT))
+                shape = (numRows[name], width) if width != 1 else (numRows[name],)
+                footer['columns'][name] = {
+                    'offset': out.tell(),
+                    'dtype': np.dtype(dtype).str,
+                    'shape': shape
+                }
+                with open(os.path.join(self._spillDir, name), 'rb') as spill:
+                    shutil.copyfileobj(spill, out)
+            footerBytes = json.dumps(footer).encode('utf-8')
+            out.write(footerBytes)
+            out.write(np.array([len(footerBytes)], dtype='<u8').tobytes())
+            out.write(_MAGIC)
+
+        shutil.rmtree(self._spillDir)
+        self._isClosed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.Close()
+
+
+class DetectionLogReader():
+    '''Memory-map a detection log. Columns are exposed as read-only numpy
+    views on the file, so opening a log is immediate regardless of its size
+    and only the accessed frames are paged in'''
+
+    def __init__(self, path : str) -> None:
+        print('Opening detection log', path, 'for reading...')
+        self._path = path
+        self._buffer = np.memmap(path, dtype=np.uint8, mode='r')
+        tailSize = len(_MAGIC) + 8
+        assert bytes(self._buffer[-len(_MAGIC):]) == _MAGIC, \
+            'Not a detection log: ' + path
+        footerSize = int(self._buffer[-tailSize:-len(_MAGIC)].view('<u8')[0])
+        footerStart = len(self._buffer) - tailSize - footerSize
+        footer = json.loads(bytes(self._buffer[footerStart:-tailSize]))
+
+        self._hasDescriptors = footer['hasDescriptors']
+        # Logs of version 1 have no embeddings
+        self._hasEmbeddings = footer.get('hasEmbeddings', False)
+        # Logs before version 3 have no appearance settings
+        self._appearanceSettings = footer.get('appearanceSettings')
+        self._columns = {}
+        for name, col in footer['columns'].items():
+            dtype = np.dtype(col['dtype'])
+            count = int(np.prod(col['shape']))
+            start = col['offset']
+            self._columns[name] = self._buffer[
+                start:start + count * dtype.itemsize
+            ].view(dtype).reshape(col['shape'])
+
+    def GetNumFrames(self) -> int:
+        return len(self._columns['frame_numbers'])
+
+    def HasDescriptors(self) -> bool:
+        return self._hasDescriptors
+
+    def HasEmbeddings(self) -> bool:
+        return self._hasEmbeddings
+
+    def GetAppearanceSettings(self) -> dict:
+        '''Settings of the appearance manager used while recording, None if
+        the tracker had no appearance manager'''
+        return self._appearanceSettings
+
+    def GetFrameNumber(self, idx : int) -> int:
+        return int(self._columns['frame_numbers'][idx])
+
+    def GetDetections(self, idx : int) -> dict:
+        '''Get detections of the idx-th recorded frame, in the same format
+        returned by MyObjectDetector.Detect'''
+        s, e = self._columns['det_offsets'][idx:idx+2]
+        return {
+            'boxes': self._columns['det_boxes'][s:e],
+            'labels': self._columns['det_labels'][s:e],
+            'scores': self._columns['det_scores'][s:e]
+        }
+
+    def GetDescriptors(self, idx : int) -> list:
+        '''Get the list of ORB descriptors of each detection of the idx-th
+        recorded frame. Detections without keypoints have None'''
+        if not self._hasDescriptors: return None
+        s, e = self._columns['det_offsets'][idx:idx+2]
+        offsets = self._columns['desc_offsets'][s:e+1]
+        descriptors = self._columns['descriptors']
+        return [descriptors[offsets[i]:offsets[i+1]] if offsets[i+1] > offsets[i]
+                else None for i in range(e - s)]
+
+    def GetEmbeddings(self, idx : int) -> np.ndarray:
+        '''Get the detector embeddings of the detections of the idx-th
+        recorded frame, as float32'''
+        if not self._hasEmbeddings: return None
+        s, e = self._columns['det_offsets'][idx:idx+2]
+        return self._columns['det_embeddings'][s:e].astype(np.float32)
+
+    def GetTrackedObjects(self, idx : int) -> dict:
+        '''Get the recorded tracker output of the idx-th frame'''
+        s, e = self._columns['trk_offsets'][idx:idx+2]
+        return {
+            'boxes': self._columns['trk_boxes'][s:e],
+            'labels': self._columns['trk_labels'][s:e],
+            'ids': self._columns['trk_ids'][s:e]
+        }
@@ -0,0 +1,179 @@
+# Date:     2026-10-19
+# Author:   Massimo Clementi <massimo_clementi@icloud.com>
+# Topic:    Host several variants of the object detector and select, for
+#           each request, the most accurate one that fits the given latency
+#           budget, based on continuously measured latencies
+
+import threading
+import time
+import numpy as np
+from CoreEngine import MyObjectDetector
+from Utilities import print_execution_time
+
+
+class DetectorVariant():
+    '''Object detector together with its measured latency'''
+
+    def __init__(self, name : str, detector : MyObjectDetector,
+                 smoothing : float) -> None:
+        self.name = name
+        self.detector = detector
+        self._smoothing = smoothing
+        self.latencyMs = None       # exponentially weighted moving average
+        self.numRequests = 0
+        self.lastUsed = 0.0
+
+    def AddLatencySample(self, latencyMs : float) -> None:
+        if self.latencyMs is None:
+            self.latencyMs = latencyMs
+        else:
+            self.latencyMs += self._smoothing * (latencyMs - self.latencyMs)
+        self.numRequests += 1
+
+    def GetStatus(self) -> dict:
+        return {
+            'name': self.name,
+            'latencyMs': self.latencyMs,
+            'numRequests': self.numRequests
+        }
+
+
+class DetectorVariantSelector():
+
+    def __init__(self, variants : list, backend = 'eager',
+                 precision = 'float32', smoothing = 0.2, concurrency = 1,
+                 reprobeInterval = 10.0) -> None:
+        '''Instantiate the detector variants. Each variant is a tuple
+        (architecture, minSize) and the list is ordered from the most
+        accurate to the fastest. Concurrency is the number of requests that
+        can be processed in parallel without slowing each other down.
+        Variants not used for reprobeInterval seconds are measured again in
+        background while the server is idle, so that estimates made stale
+        by a past load peak recover'''
+        self._variants = []
+        for architecture, minSize in variants:
+            name = architecture + '@' + str(minSize or 'default')
+            detector = MyObjectDetector(
+                backend=backend, precision=precision,
+                architecture=architecture, minSize=minSize)
+            self._variants.append(DetectorVariant(name, detector, smoothing))
+        self._concurrency = concurrency
+        self._reprobeInterval = reprobeInterval
+        self._numInFlight = 0
+        self._lock = threading.Lock()
+        self._probeShape = None
+
+    @print_execution_time
+    def CreateDNNModels(self, warmupShape = (1, 480, 640, 3)) -> None:
+        '''Create all models and get a first latency measurement of each'''
+        self._probeShape = warmupShape
+        for v in self._variants:
+            v.detector.CreateDNNModel()
+            self.Probe(v)
+        if len(self._variants) > 1:
+            threading.Thread(target=self._ReprobeLoop, daemon=True).start()
+
+    def Probe(self, variant : DetectorVariant) -> None:
+        '''Measure the latency of a variant on a blank image with the shape
+        of the last request'''
+        images = np.zeros(self._probeShape, dtype=np.uint8)
+        start = time.perf_counter()
+        variant.detector.Detect(images, minScore=1.0)
+        with self._lock:
+            # The previous estimate is stale, replace it
+            variant.latencyMs = None
+            variant.AddLatencySample((time.perf_counter() - start) * 1e3)
+            variant.lastUsed = time.monotonic()
+
+    def _ReprobeLoop(self) -> None:
+        '''Measure again variants not used for a while, only when no
+        request is in flight, so that probes do not delay requests'''
+        while True:
+            time.sleep(self._reprobeInterval)
+            for v in self._variants:
+                with self._lock:
+                    if self._numInFlight > 0 or \
+                            time.monotonic() - v.lastUsed <= self._reprobeInterval:
+                        continue
+                    # Requests arriving meanwhile account for the probe
+                    self._numInFlight += 1
+                try:
+                    print('Probing latency of variant', v.name, '...')
+                    self.Probe(v)
+                finally:
+                    with self._lock:
+                        self._numInFlight -= 1
+
+    def GetExpectedLatency(self, variant : DetectorVariant) -> float:
+        '''Expected latency of a new request, taking into account that it
+        has to share the server with the requests already in flight'''
+        if variant.latencyMs is None: return 0.0
+        return variant.latencyMs * (1 + self._numInFlight / self._concurrency)
+
+    def Select(self, latencyBudgetMs : float = None) -> DetectorVariant:
+        '''Get the most accurate variant expected to fit the budget, or the
+        fastest one if none does'''
+        with self._lock:
+            selected = self._variants[-1]
+            for v in self._variants:
+                if latencyBudgetMs is None or \
+                        self.GetExpectedLatency(v) <= latencyBudgetMs:
+                    selected = v
+                    break
+            selected.lastUsed = time.monotonic()
+            return selected
+
+    def Detect(self, images : np.ndarray, minScore : float,
+               latencyBudgetMs : float = None,
+               embeddingsType : str = None) -> tuple:
+        '''Detect objects with the variant selected for the latency budget.
+        Return the predictions and the name of the variant used'''
+        variant = self.Select(latencyBudgetMs)
+        with self._lock:
+            self._numInFlight += 1
+            self._probeShape = images.shape
+        try:
+            start = time.perf_counter()
+            predictions = variant.detector.Detect(images, minScore,
+                                                  embeddingsType)
+            latencyMs = (time.perf_counter() - start) * 1e3
+        finally:
+            with self._lock:
+                self._numInFlight -= 1
+        with self._lock:
+            variant.AddLatencySample(latencyMs)
+        print('Detected with variant', variant.name, 'in', int(latencyMs), 'ms')
+        return predictions, variant.name
+
+    def DetectTiled(self, image : np.ndarray, minScore : float,
+                    tileSize : int, overlap : int, batchSize : int,
+                    embeddingsType : str = None) -> tuple:
+        '''Detect objects in overlapping tiles of a single high resolution
+        image, with the most accurate variant. Its latency grows with the
+        image area, so it does not update the latency estimate of the
+        variant. Return the predictions and the name of the variant used'''
+        variant = self._variants[0]
+        with self._lock:
+            self._numInFlight += 1
+        try:
+            predictions = variant.detector.DetectTiled(
+                image, minScore, tileSize, overlap, batchSize,
+                embeddingsType=embeddingsType)
+        finally:
+            with self._lock:
+                self._numInFlight -= 1
+        return predictions, variant.name
+
+    def GetStatus(self) -> list:
+        with self._lock:
+            return [v.GetStatus() for v in self._variants]
+
+
+def ParseVariants(description : str) -> list:
+    '''Parse variants given as comma separated architecture:minSize entries,
+    where minSize can be omitted to use the model default'''
+    variants = []
+    for entry in description.split(','):
+        architecture, _, minSize = entry.strip().partition(':')
+        variants.append((architecture, int(minSize) if minSize else None))
+    return variants
@@ -60,3 +60,29 @@ class EncoderDecoderNumpy():
         a_restored = np.asarray(json_load["data"])
         return a_restored    
 
+
+# Convert numpy ndarrays to a compact base64 representation of their raw
+# bytes, keeping dtype and shape. Better suited than the JSON list
+# representation for large arrays such as embeddings
+class EncoderDecoderNumpyBinary():
+
+    @print_execution_time
+    def Encode(self, data : np.array, dtype : type) -> str:
+        print('Encoding binary array...')
+        data = np.ascontiguousarray(data, dtype=dtype)
+        json_dump = json.dumps({
+            'dtype': data.dtype.str,
+            'shape': data.shape,
+            'data': base64.b64encode(data.tobytes()).decode('utf-8')
+        })
+        return json_dump
+
+    @print_execution_time
+    def Decode(self, dataEncoded : str, dtype : type) -> np.array:
+        print('Decoding binary array...')
+        json_load = json.loads(dataEncoded)
+        a_restored = np.frombuffer(
+            base64.b64decode(json_load['data']),
+            dtype=np.dtype(json_load['dtype'])
+        ).reshape(json_load['shape'])
+        return a_restored.astype(dtype, copy=False)
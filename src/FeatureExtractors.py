@@ -28,6 +28,14 @@ class FeatureExtractorORB(FeatureExtractor):
         # print('Number of keypoints detected:', len(self._keypoints))
         self.isSuccessful = len(self._keypoints) > 0
 
+    def SetFeatures(self, descriptors : np.ndarray) -> None:
+        '''Set precomputed descriptors (e.g. replayed from a detection log).
+        Keypoint positions are not stored, so none are set'''
+        self._image = None
+        self._keypoints = ()
+        self._descriptors = descriptors
+        self.isSuccessful = descriptors is not None and len(descriptors) > 0
+
     def GetFeatures(self) -> tuple:
         return self._keypoints, self._descriptors
     
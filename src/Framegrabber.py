@@ -2,6 +2,9 @@
 # Author:   Massimo Clementi <massimo_clementi@icloud.com>
 # Topic:    Class that defines a custom framegrabber
 
+import collections
+import threading
+import time
 import cv2
 
 class Framegrabber:
@@ -66,3 +69,156 @@ class Framegrabber:
 
     def set_sampling_interval(self, sample_interval):
         self.__frameSamplingInterval = max(1, sample_interval)
+
+
+class MultiFramegrabber:
+    """Grab synchronized frame sets from several sources, e.g. the cameras
+    of a robot. Each source is decoded on its own thread into a bounded
+    buffer, and frames of different sources are aligned by timestamp.
+    Video files are timestamped by their position in the video and are
+    never dropped (decoding waits for free space), while live sources are
+    timestamped on capture and the oldest buffered frame is dropped when
+    the consumer falls behind. Several video files recorded at the same
+    time can be used as stand-ins for the cameras."""
+
+    def __init__(self, paths, tolerance_ms=20., buffer_size=4,
+                 scaling_factor=1.):
+        """Instantiate a grabber of the given sources. Frames of a set are
+        within tolerance_ms from each other"""
+        print('Opening multi-source framegrabber...')
+        self.paths = list(paths)
+        self.stream_ended = False
+        self.__tolerance_ms = tolerance_ms
+        self.__buffer_size = buffer_size
+        self.__scaling_factor = scaling_factor
+        self.__condition = threading.Condition()
+        self.__is_running = True
+        self.__start_time = time.monotonic()
+        self.__last_timestamps = None
+        self.__sources = []
+        for path in self.paths:
+            cap = cv2.VideoCapture(path)
+            assert cap.isOpened(), 'Cannot open source ' + str(path)
+            self.__sources.append({
+                'path': path,
+                'cap': cap,
+                # Cameras are given by index or by stream URL
+                'is_live': isinstance(path, int) or '://' in str(path),
+                'buffer': collections.deque(),
+                'is_ended': False,
+                'num_decoded': 0,
+                'num_dropped': 0,
+                'num_skipped': 0,
+                'lag_ms': None
+            })
+        self.__threads = [
+            threading.Thread(target=self.__decode_loop, args=(source,),
+                             daemon=True)
+            for source in self.__sources
+        ]
+        for thread in self.__threads:
+            thread.start()
+
+    def __decode_loop(self, source):
+        """Decode frames of a source into its buffer"""
+        while self.__is_running:
+            ret, frame = source['cap'].read()
+            if not ret:
+                break
+            if source['is_live']:
+                timestamp = (time.monotonic() - self.__start_time) * 1e3
+            else:
+                timestamp = source['cap'].get(cv2.CAP_PROP_POS_MSEC)
+            if self.__scaling_factor != 1.:
+                frame = cv2.resize(
+                    frame, (int(frame.shape[1] * self.__scaling_factor),
+                            int(frame.shape[0] * self.__scaling_factor)),
+                    interpolation=cv2.INTER_AREA)
+
+            with self.__condition:
+                while not source['is_live'] and self.__is_running and \
+                        len(source['buffer']) >= self.__buffer_size:
+                    self.__condition.wait()
+                if len(source['buffer']) >= self.__buffer_size:
+                    source['buffer'].popleft()
+                    source['num_dropped'] += 1
+                source['buffer'].append((timestamp, time.monotonic(), frame))
+                source['num_decoded'] += 1
+                self.__condition.notify_all()
+
+        with self.__condition:
+            source['is_ended'] = True
+            self.__condition.notify_all()
+
+    def is_ended(self):
+        """Return if any stream has ended (no more complete frame sets)"""
+        return self.stream_ended
+
+    def grab_frames(self):
+        """Get the next set of frames, one per source and within tolerance
+        from each other, or None when a source has ended. Frames of the
+        same size can be stacked into a batch with np.stack"""
+        with self.__condition:
+            while True:
+                # Wait for a frame of every source
+                self.__condition.wait_for(lambda: all(
+                    s['buffer'] or s['is_ended'] for s in self.__sources))
+                if any(not s['buffer'] for s in self.__sources):
+                    self.stream_ended = True
+                    return None
+
+                # Frames older than the newest head by more than the
+                # tolerance cannot be part of a set, skip them
+                newest = max(s['buffer'][0][0] for s in self.__sources)
+                is_aligned = True
+                for s in self.__sources:
+                    if s['buffer'][0][0] < newest - self.__tolerance_ms:
+                        s['buffer'].popleft()
+                        s['num_skipped'] += 1
+                        is_aligned = False
+                self.__condition.notify_all()
+                if is_aligned:
+                    break
+
+            now = time.monotonic()
+            frames = []
+            self.__last_timestamps = []
+            for s in self.__sources:
+                timestamp, decode_time, frame = s['buffer'].popleft()
+                s['lag_ms'] = (now - decode_time) * 1e3
+                frames.append(frame)
+                self.__last_timestamps.append(timestamp)
+            self.__condition.notify_all()
+        return frames
+
+    def get_timestamps(self):
+        """Get the timestamps (ms) of the frames of the last set"""
+        return self.__last_timestamps
+
+    def get_status(self):
+        """Get decoding status of each source. Lag is the time between
+        decoding and delivery of its last frame; dropped frames were
+        overwritten in a full buffer, skipped frames had no match within
+        tolerance in the other sources"""
+        with self.__condition:
+            return [{
+                'path': s['path'],
+                'decoded': s['num_decoded'],
+                'dropped': s['num_dropped'],
+                'skipped': s['num_skipped'],
+                'buffered': len(s['buffer']),
+                'lag_ms': s['lag_ms']
+            } for s in self.__sources]
+
+    def cap_release(self):
+        print('Closing multi-source framegrabber...')
+        with self.__condition:
+            self.__is_running = False
+            self.__condition.notify_all()
+        for thread in self.__threads:
+            thread.join()
+        for s in self.__sources:
+            s['cap'].release()
+
+    def set_scaling_factor(self, scaling_factor):
+        self.__scaling_factor = scaling_factor
@@ -0,0 +1,326 @@
+# Date:     2026-10-19
+# Author:   Massimo Clementi <massimo_clementi@icloud.com>
+# Topic:    Define various inference backends for the object detector. All
+#           backends share the same Detect contract: a batch of images
+#           (N, H, W, 3) goes in, a list with one dict of numpy arrays
+#           'boxes', 'labels', 'scores' per image comes out
+
+import inspect
+import os
+import threading
+import time
+import numpy as np
+import torch
+from Utilities import print_execution_time
+
+
+class InferenceBackend():
+    '''Common interface of inference backends'''
+
+    name = None
+    supportsEmbeddings = False
+
+    # Max number of free input buffers kept for reuse
+    maxPooledBuffers = 8
+
+    def __init__(self, device : torch.device, precision : str) -> None:
+        self.device = device
+        self.precision = precision
+        self.dtype = getattr(torch, precision)
+        # Input buffers are reused across calls with the same input shape
+        # and type. The server handles each request in a new thread, so
+        # free buffers are kept in a pool shared by all threads
+        self._freeBuffers = []
+        self._buffersLock = threading.Lock()
+
+    @staticmethod
+    def IsAvailable() -> bool:
+        return True
+
+    def Load(self, createEagerModel, artifactPath : str) -> None:
+        '''Load the model. The eager model, with weights loaded, is created
+        by calling createEagerModel(); backends that export the model
+        cache the exported artifact at artifactPath'''
+        raise NotImplementedError
+
+    def Predict(self, x : torch.Tensor) -> list:
+        '''Run the model on a batch (N, 3, H, W) of normalized images and
+        return a list of dicts of tensors'''
+        raise NotImplementedError
+
+    def PredictWithEmbeddings(self, x : torch.Tensor) -> list:
+        '''Same as Predict, also returning for each box a L2 normalized
+        appearance embedding under the 'embeddings' key'''
+        raise NotImplementedError
+
+    def AcquireInputBuffer(self, shape : tuple, dtype, allocate):
+        '''Take a free input buffer of the given shape and type from the
+        pool, or allocate one by calling allocate(shape). The buffer is
+        owned by the caller until given back by ReleaseInputBuffer'''
+        key = (tuple(shape), str(dtype))
+        with self._buffersLock:
+            for i, (k, buffer) in enumerate(self._freeBuffers):
+                if k == key:
+                    del self._freeBuffers[i]
+                    return buffer
+        return allocate(shape)
+
+    def ReleaseInputBuffer(self, buffer) -> None:
+        '''Give back a buffer to the pool. The least recently released
+        buffers are dropped beyond maxPooledBuffers, to bound memory usage'''
+        key = (tuple(buffer.shape), str(buffer.dtype))
+        with self._buffersLock:
+            self._freeBuffers.append((key, buffer))
+            if len(self._freeBuffers) > self.maxPooledBuffers:
+                del self._freeBuffers[0]
+
+    def Preprocess(self, images : np.ndarray) -> torch.Tensor:
+        '''Convert images to normalized (N, 3, H, W) batch in the backend
+        precision. The uint8 images are wrapped without copying, then layout,
+        type conversion and normalization are done in a single pass into a
+        pooled buffer, which is to be released after use'''
+        x = torch.from_numpy(np.ascontiguousarray(images)).permute(0, 3, 1, 2)
+        if self.device.type != 'cpu':
+            # Transfer the compact uint8 images, convert on the device
+            x = x.to(self.device, non_blocking=True)
+        buffer = self.AcquireInputBuffer(
+            tuple(x.shape), self.dtype, lambda shape: torch.empty(
+                shape, dtype=self.dtype, device=self.device))
+        buffer.copy_(x)
+        return buffer.div_(255)
+
+    def Detect(self, images : np.ndarray, minScore : float,
+               withEmbeddings = False) -> list:
+        '''Detect objects in the images'''
+        x = self.Preprocess(images)
+        try:
+            with torch.no_grad():
+                if withEmbeddings:
+                    predictions = self.PredictWithEmbeddings(x)
+                else:
+                    predictions = self.Predict(x)
+        finally:
+            # Outputs do not reference the input, it can be reused
+            self.ReleaseInputBuffer(x)
+
+        print('Selecting matches by score...')
+        results = []
+        for p in predictions:
+            mask = p['scores'] > minScore
+            results.append({
+                key: p[key][mask].detach().cpu().numpy() for key in p
+            })
+        return results
+
+
+class InferenceBackendEager(InferenceBackend):
+    '''Plain torchvision model, executed in eager mode'''
+
+    name = 'eager'
+    artifactExtension = None
+    supportsEmbeddings = True
+
+    def Load(self, createEagerModel, artifactPath : str) -> None:
+        self._model = createEagerModel().to(self.dtype).eval()
+
+    def Predict(self, x : torch.Tensor) -> list:
+        return self._model(x)
+
+    def PredictWithEmbeddings(self, x : torch.Tensor) -> list:
+        # Same steps of GeneralizedRCNN.forward, keeping the backbone
+        # features to ROI pool them again on the final boxes. The box head
+        # representation of each box is used as its embedding
+        model = self._model
+        originalSizes = [image.shape[-2:] for image in x]
+        imageList, _ = model.transform(list(x))
+        features = model.backbone(imageList.tensors)
+        proposals, _ = model.rpn(imageList, features)
+        detections, _ = model.roi_heads(features, proposals, imageList.image_sizes)
+
+        boxes = [d['boxes'] for d in detections]
+        embeddings = model.roi_heads.box_head(model.roi_heads.box_roi_pool(
+            features, boxes, imageList.image_sizes))
+        embeddings = torch.nn.functional.normalize(embeddings.float(), dim=1)
+
+        detections = model.transform.postprocess(
+            detections, imageList.image_sizes, originalSizes)
+        for d, e in zip(detections, embeddings.split([len(b) for b in boxes])):
+            d['embeddings'] = e
+        return detections
+
+
+class InferenceBackendTorchScript(InferenceBackend):
+    '''Scripted and frozen model. The exported artifact is cached on disk
+    and loaded directly on later starts, then optimized for inference
+    (optimized graphs cannot be serialized)'''
+
+    name = 'torchscript'
+    artifactExtension = '.pt'
+
+    @print_execution_time
+    def Load(self, createEagerModel, artifactPath : str) -> None:
+        if not os.path.exists(artifactPath):
+            self.Export(createEagerModel().to(self.dtype).eval(), artifactPath)
+        import torchvision  # registers torchvision ops for TorchScript
+        print('Loading TorchScript artifact', artifactPath)
+        self._model = torch.jit.load(artifactPath, map_location=self.device)
+        try:
+            self._model = torch.jit.optimize_for_inference(self._model)
+        except Exception as e:
+            print('Cannot optimize TorchScript model for inference:', e)
+
+    @print_execution_time
+    def Export(self, model : torch.nn.Module, artifactPath : str) -> None:
+        print('Exporting model to TorchScript...')
+        scripted = torch.jit.script(model)
+        try:
+            scripted = torch.jit.freeze(scripted)
+        except Exception as e:
+            print('Freezing not supported, keeping scripted model:', e)
+        os.makedirs(os.path.dirname(artifactPath), exist_ok=True)
+        torch.jit.save(scripted, artifactPath + '.tmp')
+        os.replace(artifactPath + '.tmp', artifactPath)
+
+    def Predict(self, x : torch.Tensor) -> list:
+        # Scripted detection models always return (losses, detections)
+        _, detections = self._model(list(x))
+        return detections
+
+
+class InferenceBackendONNXRuntime(InferenceBackend):
+    '''Model exported to ONNX and executed by ONNX Runtime, if installed.
+    The exported graph takes one image at a time'''
+
+    name = 'onnxruntime'
+    artifactExtension = '.onnx'
+
+    @staticmethod
+    def IsAvailable() -> bool:
+        try:
+            import onnxruntime
+        except ImportError:
+            return False
+        return True
+
+    @print_execution_time
+    def Load(self, createEagerModel, artifactPath : str) -> None:
+        import onnxruntime
+        assert self.precision == 'float32', \
+            'ONNX Runtime backend only supports float32 precision'
+        if not os.path.exists(artifactPath):
+            self.Export(createEagerModel().eval(), artifactPath)
+        print('Loading ONNX artifact', artifactPath)
+        providers = ['CPUExecutionProvider']
+        if self.device.type == 'cuda':
+            providers.insert(0, 'CUDAExecutionProvider')
+        self._session = onnxruntime.InferenceSession(
+            artifactPath, providers=providers)
+
+    @print_execution_time
+    def Export(self, model : torch.nn.Module, artifactPath : str) -> None:
+        print('Exporting model to ONNX...')
+        os.makedirs(os.path.dirname(artifactPath), exist_ok=True)
+        sample = torch.rand(3, 480, 640, device=next(model.parameters()).device)
+        # Recent torch versions default to the dynamo exporter, which does
+        # not support these models; older ones do not have the keyword
+        kwargs = {}
+        if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+            kwargs['dynamo'] = False
+        torch.onnx.export(
+            model, ([sample],), artifactPath + '.tmp', opset_version=11,
+            input_names=['image'], output_names=['boxes', 'labels', 'scores'],
+            dynamic_axes={'image': [1, 2], 'boxes': [0], 'labels': [0],
+                          'scores': [0]},
+            **kwargs)
+        os.replace(artifactPath + '.tmp', artifactPath)
+
+    def Preprocess(self, images : np.ndarray) -> np.ndarray:
+        x = np.transpose(np.asarray(images), (0, 3, 1, 2))
+        buffer = self.AcquireInputBuffer(x.shape, np.dtype(np.float32), lambda shape: np.empty(
+            shape, dtype=np.float32))
+        return np.divide(x, np.float32(255), out=buffer)
+
+    def Predict(self, x : np.ndarray) -> list:
+        predictions = []
+        for image in x:
+            boxes, labels, scores = self._session.run(None, {'image': image})
+            predictions.append({
+                'boxes': torch.from_numpy(boxes),
+                'labels': torch.from_numpy(labels),
+                'scores': torch.from_numpy(scores)
+            })
+        return predictions
+
+
+class InferenceBackendStub(InferenceBackend):
+    '''Stand-in for the model, used to load test the server without weights.
+    It returns random boxes after a synthetic latency, configured by the
+    environment variables:
+    - TRIP_STUB_LATENCY_MS: mean latency of each call (default 50)
+    - TRIP_STUB_JITTER_MS: standard deviation of the latency (default 0)
+    - TRIP_STUB_NUM_OBJECTS: objects returned for each image (default 5)
+    - TRIP_STUB_BUSY: if 1, spin the CPU instead of sleeping, to simulate
+      compute bound inference (default 0)'''
+
+    name = 'stub'
+    artifactExtension = None
+
+    def __init__(self, device : torch.device, precision : str) -> None:
+        super().__init__(device, precision)
+        self._latencyMs = float(os.environ.get('TRIP_STUB_LATENCY_MS', 50))
+        self._jitterMs = float(os.environ.get('TRIP_STUB_JITTER_MS', 0))
+        self._numObjects = int(os.environ.get('TRIP_STUB_NUM_OBJECTS', 5))
+        self._isBusy = os.environ.get('TRIP_STUB_BUSY', '0') == '1'
+
+    def Load(self, createEagerModel, artifactPath : str) -> None:
+        print('Using stub detector with', self._latencyMs, 'ms latency')
+
+    def Wait(self, rng : np.random.Generator) -> None:
+        latency = max(0.0, rng.normal(self._latencyMs, self._jitterMs)) / 1e3
+        if self._isBusy:
+            end = time.perf_counter() + latency
+            while time.perf_counter() < end:
+                pass
+        else:
+            time.sleep(latency)
+
+    def Detect(self, images : np.ndarray, minScore : float,
+               withEmbeddings = False) -> list:
+        # Generators are not thread safe, use one for each call
+        rng = np.random.default_rng()
+        self.Wait(rng)
+        results = []
+        for image in images:
+            h, w = image.shape[:2]
+            corners = rng.uniform((0, 0, 0, 0), (w, h, w, h),
+                                        (self._numObjects, 4))
+            results.append({
+                'boxes': np.hstack((np.minimum(corners[:, :2], corners[:, 2:]),
+                                    np.maximum(corners[:, :2], corners[:, 2:])))
+                                    .astype(np.float32),
+                'labels': rng.integers(1, 91, self._numObjects),
+                'scores': rng.uniform(minScore, 1.0, self._numObjects)
+                              .astype(np.float32)
+            })
+        return results
+
+
+_BACKENDS = {
+    b.name: b for b in (InferenceBackendEager,
+                        InferenceBackendTorchScript,
+                        InferenceBackendONNXRuntime,
+                        InferenceBackendStub)
+}
+
+def GetAvailableBackends() -> list:
+    return [name for name, b in _BACKENDS.items() if b.IsAvailable()]
+
+def CreateInferenceBackend(name : str, device : torch.device,
+                           precision : str) -> InferenceBackend:
+    '''Instantiate the backend with the given name, falling back to eager
+    mode if it is not available on this system'''
+    assert name in _BACKENDS, 'Unknown inference backend: ' + name
+    if not _BACKENDS[name].IsAvailable():
+        print('Inference backend', name, 'not available, using eager mode')
+        name = InferenceBackendEager.name
+    return _BACKENDS[name](device, precision)
@@ -0,0 +1,153 @@
+# Date:     2026-10-19
+# Author:   Massimo Clementi <massimo_clementi@icloud.com>
+# Topic:    Load generator for the elaboration server. Many simulated
+#           clients send DetectObjects requests at increasing offered rates,
+#           and throughput, latency percentiles, error rates and saturation
+#           point are reported as JSON.
+#
+#           To test the serving path without weights nor GPU, run the server
+#           with the stub detector, e.g.
+#           TRIP_DETECTOR_BACKEND=stub TRIP_STUB_LATENCY_MS=50 python3 Server.py
+
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import requests
+from EncoderDecoder import EncoderDecoderImage
+
+
+class LoadGenerator():
+
+    def __init__(self, url : str, numClients : int, payloads : list,
+                 timeout : float) -> None:
+        '''Payloads are the JSON requests to send, in round robin'''
+        self._url = url + '/api/v1.0/detectobjects'
+        self._numClients = numClients
+        self._payloads = payloads
+        self._timeout = timeout
+        self._sessions = threading.local()
+
+    def _Send(self, payload : dict, scheduledTime : float) -> tuple:
+        # Each simulated client keeps its own connection alive
+        if not hasattr(self._sessions, 'session'):
+            self._sessions.session = requests.Session()
+        try:
+            response = self._sessions.session.post(
+                self._url, json=payload, timeout=self._timeout)
+            isOK = response.status_code == 200
+        except requests.RequestException:
+            isOK = False
+        # Latency is measured from the scheduled send time, so that time
+        # spent waiting for a free client is also accounted for
+        return isOK, time.perf_counter() - scheduledTime
+
+    def RunStep(self, rate : float, duration : float) -> dict:
+        '''Send requests at the given offered rate (requests per second,
+        with Poisson arrivals) for the given duration'''
+        print('Offering', rate, 'requests/s for', duration, 's...')
+        rng = np.random.default_rng()
+        futures = []
+        with ThreadPoolExecutor(max_workers=self._numClients) as executor:
+            start = time.perf_counter()
+            nextTime = start
+            i = 0
+            while nextTime < start + duration:
+                delay = nextTime - time.perf_counter()
+                if delay > 0: time.sleep(delay)
+                payload = self._payloads[i % len(self._payloads)]
+                futures.append(executor.submit(self._Send, payload, nextTime))
+                nextTime += rng.exponential(1.0 / rate)
+                i += 1
+            results = [f.result() for f in futures]
+            elapsed = time.perf_counter() - start
+
+        latencies = np.array([l for ok, l in results if ok]) * 1e3
+        numErrors = sum(1 for ok, _ in results if not ok)
+        stats = {
+            'offeredRate': rate,
+            'numRequests': len(results),
+            'throughput': len(latencies) / elapsed,
+            'errorRate': numErrors / max(1, len(results))
+        }
+        for p in (50, 90, 99):
+            stats['p' + str(p) + 'Ms'] = \
+                float(np.percentile(latencies, p)) if len(latencies) else None
+        stats['maxMs'] = float(np.max(latencies)) if len(latencies) else None
+        return stats
+
+
+def IsSaturated(stats : dict, sloMs : float, maxErrorRate : float) -> bool:
+    '''A step is saturated if the server does not keep up with the offered
+    rate, violates the latency objective or returns too many errors'''
+    return stats['throughput'] < 0.9 * stats['offeredRate'] or \
+        stats['p99Ms'] is None or stats['p99Ms'] > sloMs or \
+        stats['errorRate'] > maxErrorRate
+
+def CreatePayloads(imagePath : str, sizes : list) -> list:
+    '''Encode the test image once for each of the given (width, height)'''
+    image = cv2.imread(imagePath)
+    assert image is not None, 'Cannot read image ' + imagePath
+    return [
+        {'image': EncoderDecoderImage().Encode(
+            cv2.resize(image, size, interpolation=cv2.INTER_AREA), np.uint8)}
+        for size in sizes
+    ]
+
+def ParseSize(size : str) -> tuple:
+    width, height = size.lower().split('x')
+    return int(width), int(height)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Load test the elaboration server')
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--clients', type=int, default=32,
+                        help='number of simulated clients')
+    parser.add_argument('--rates', default='1,2,5,10,20,50',
+                        help='comma separated offered rates, requests/s')
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='duration of each rate step, in seconds')
+    parser.add_argument('--sizes', default='640x480',
+                        help='comma separated image sizes, e.g. 640x480,1280x720')
+    parser.add_argument('--image', default='../images/test-1.jpg')
+    parser.add_argument('--timeout', type=float, default=10.0)
+    parser.add_argument('--sloMs', type=float, default=1000.0,
+                        help='p99 latency objective, in milliseconds')
+    parser.add_argument('--maxErrorRate', type=float, default=0.01)
+    parser.add_argument('--output', default=None,
+                        help='write results as JSON to this path')
+    args = parser.parse_args()
+
+    payloads = CreatePayloads(
+        args.image, [ParseSize(s) for s in args.sizes.split(',')])
+    generator = LoadGenerator(args.url, args.clients, payloads, args.timeout)
+
+    steps = []
+    saturationRate = None
+    for rate in [float(r) for r in args.rates.split(',')]:
+        stats = generator.RunStep(rate, args.duration)
+        stats['saturated'] = IsSaturated(stats, args.sloMs, args.maxErrorRate)
+        steps.append(stats)
+        if stats['saturated']:
+            saturationRate = rate
+            break
+
+    sustainable = [s['offeredRate'] for s in steps if not s['saturated']]
+    results = {
+        'url': args.url,
+        'clients': args.clients,
+        'sizes': args.sizes.split(','),
+        'steps': steps,
+        'saturationRate': saturationRate,
+        'maxSustainableRate': max(sustainable) if sustainable else None
+    }
+
+    print(json.dumps(results, indent=2))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -3,13 +3,14 @@
 # Topic:    Define a multiobjects tracker
 
 import numpy as np
-from Utilities import print_execution_time, GetNthOccurenceIndex, \
-                        GetIndexesFromMask
+from Utilities import print_execution_time, GetIndexesFromMask
 from scipy.spatial import distance_matrix
 from Enums import MatchClassification
 import BoundingBox
 from FeatureExtractors import FeatureExtractor, FeatureExtractorORB
 from FeatureMatchers import FeatureMatcher, FeatureMatcherORB
+from TrackStore import TrackStore
+from AppearanceManager import AppearanceManager
 import cv2
 
 class MultiObjectTracker():
@@ -17,30 +18,66 @@ class MultiObjectTracker():
     def __init__(self, maxNumTrackedObjects : int,
                  correspondenceMaxDistance : int,
                  occlusionMinDistance : int,
-                 distanceFeaturesWeightFactor : float) -> None:
+                 distanceFeaturesWeightFactor : float,
+                 capacityPolicy = 'grow',
+                 embeddingDistanceScale = 100.0,
+                 appearanceManager : AppearanceManager = None) -> None:
         # Initialize parameters
+        # maxNumTrackedObjects is the initial capacity. When exceeded,
+        # capacity is either doubled or the lowest life track is evicted,
+        # according to capacityPolicy ('grow' or 'evict')
         self._maxNumTrackedObjects = maxNumTrackedObjects
         self._minLife = 0
         self._maxLife = 7
         self._correspondenceMaxDistance = correspondenceMaxDistance
         self._occlusionMinDistance = occlusionMinDistance
         self._distanceFeaturesWeightFactor = distanceFeaturesWeightFactor
+        # Cosine distance between embeddings is in [0, 2], scale it to be
+        # comparable with center distances in pixels
+        self._embeddingDistanceScale = embeddingDistanceScale
+        # If given, the appearance manager selects which detections get
+        # their features extracted in each frame and when track templates
+        # are refreshed. Otherwise features of all detections are extracted
+        # and templates are only set when tracks are created
+        self._appearanceManager = appearanceManager
 
         # Initialize data arrays
-        self._bboxes = np.zeros((self._maxNumTrackedObjects, 4))
-        self._labels = np.zeros(self._maxNumTrackedObjects, dtype=int)
-        self._features = np.ndarray(self._maxNumTrackedObjects, dtype=FeatureExtractor)
-        for i in range(self._maxNumTrackedObjects):
-            self._features[i] = FeatureExtractorORB()
-        self._movementVecs = np.zeros((self._maxNumTrackedObjects, 2))
-        self._trackingIDs = np.zeros(self._maxNumTrackedObjects, dtype=int)
-        self._lives =  np.zeros(self._maxNumTrackedObjects, dtype=int)
+        self._tracks = TrackStore(self._maxNumTrackedObjects, self._minLife,
+                                  capacityPolicy)
+        self._lastDetectedFeatures = np.ndarray(0, dtype=FeatureExtractor)
 
     @print_execution_time
     def Update(self, image : np.ndarray, dBoxes : np.ndarray, 
-               dLabels : np.ndarray) -> None:
-
-        currtUpdated =  np.zeros(self._maxNumTrackedObjects, dtype=bool)
+               dLabels : np.ndarray, dFeatures : np.ndarray = None,
+               dEmbeddings : np.ndarray = None) -> None:
+        '''Update tracked objects with the detections of a new frame. The
+        features of the detections can be provided (e.g. when replaying a
+        detection log), otherwise they are extracted from the image. If
+        the detector embeddings of the detections are provided, they are
+        used as appearance instead of ORB features'''
+
+        currtUpdated =  np.zeros(self._tracks.GetCapacity(), dtype=bool)
+        # New matches are inserted once all tracks of the frame have been
+        # classified and updated, so that an insert evicting a track can
+        # not overwrite a track matched by another detection
+        newMatches = []
+
+        if self._appearanceManager is not None:
+            self._appearanceManager.StartFrame()
+
+        # Extract features of all detected matches, or of those selected by
+        # the appearance manager
+        if dFeatures is None and dEmbeddings is None:
+            if self._appearanceManager is not None:
+                dFeatures = self._appearanceManager.ExtractFeatures(
+                    image, dBoxes, dLabels, self._tracks,
+                    self.GetPredictedPosition(self._tracks.bboxes,
+                                              self._tracks.movementVecs),
+                    self._correspondenceMaxDistance, self._occlusionMinDistance)
+            else:
+                dFeatures = self.ExtractFeatures(image, dBoxes)
+        self._lastDetectedFeatures = dFeatures
+        self._tracks.templateAges += 1
 
         # For each unique class of detected matches
         for l in np.unique(dLabels):
@@ -51,18 +88,22 @@ class MultiObjectTracker():
             dBoxesCurrLabel = dBoxes[dCurrLabelMask]
 
             # Between tracked object, select those which are of given class
-            tCurrLabelMask = np.logical_and(self._labels == l, self._lives > 0)
+            tCurrLabelMask = np.logical_and(self._tracks.labels == l, self._tracks.lives > 0)
             tCurrLabelIndexes = GetIndexesFromMask(tCurrLabelMask)
-            tBoxesCurrLabel = self._bboxes[tCurrLabelMask]
-
-            # Extract features of detected matches
-            dFeaturesCurrLabel = self.ExtractFeatures(image, dBoxesCurrLabel)
-
-            # Get features of tracked matches
-            tFeaturesCurrLabel = self._features[tCurrLabelMask]
+            tBoxesCurrLabel = self._tracks.bboxes[tCurrLabelMask]
+
+            # Get appearance of detected and tracked matches, either as
+            # detector embeddings or as ORB features
+            if dEmbeddings is not None:
+                dFeaturesCurrLabel = dEmbeddings[dCurrLabelMask]
+                tFeaturesCurrLabel = self._tracks.GetEmbeddings(
+                    tCurrLabelMask, dEmbeddings.shape[1])
+            else:
+                dFeaturesCurrLabel = dFeatures[dCurrLabelMask]
+                tFeaturesCurrLabel = self._tracks.features[tCurrLabelMask]
             
             # Compute predicted position of tracked objects
-            tMovementVecsCurrLabel = self._movementVecs[tCurrLabelMask]
+            tMovementVecsCurrLabel = self._tracks.movementVecs[tCurrLabelMask]
             tPredictedBoxesCurrLabel = self.GetPredictedPosition(
                 tBoxesCurrLabel, tMovementVecsCurrLabel)
 
@@ -82,9 +123,19 @@ class MultiObjectTracker():
                 matrixCentersDistances = self.ComputeDistancesMatrix(
                     dCentersCurrLabel, tPredictedCentersCurrLabel
                 )
-                matrixFeaturesDistances = self.ComputeFeatureDiffMatrix(
-                    dFeaturesCurrLabel, tFeaturesCurrLabel
-                )
+                if self._appearanceManager is not None and dEmbeddings is None:
+                    # Only pairs which can be associated are matched, within
+                    # the frame budget, rows which can not be fully matched
+                    # are compared by geometry only
+                    matrixFeaturesDistances = \
+                        self._appearanceManager.ComputeFeatureDiffMatrix(
+                            dFeaturesCurrLabel, tFeaturesCurrLabel,
+                            matrixCentersDistances,
+                            self._correspondenceMaxDistance + self._occlusionMinDistance)
+                else:
+                    matrixFeaturesDistances = self.ComputeFeatureDiffMatrix(
+                        dFeaturesCurrLabel, tFeaturesCurrLabel
+                    )
 
             # Based of center distances and features distances, classify each
             # match as either:
@@ -114,12 +165,21 @@ class MultiObjectTracker():
                     currtIndex = tCurrLabelIndexes[currCorrespondIndex]
                     # print("Updating tracked object at index", currtIndex, "...")
                     currtUpdated[currtIndex] = True
-                    self._movementVecs[currtIndex] = BoundingBox.GetDelta(
-                        dBoxesCurrLabel[dIdx], self._bboxes[currtIndex]
+                    self._tracks.movementVecs[currtIndex] = BoundingBox.GetDelta(
+                        dBoxesCurrLabel[dIdx], self._tracks.bboxes[currtIndex]
                     )
-                    self._bboxes[currtIndex] = dBoxesCurrLabel[dIdx]
-                    self._lives[currtIndex] =+ self.UpdateLifeIndex(
-                        self._lives[currtIndex], True
+                    self._tracks.bboxes[currtIndex] = dBoxesCurrLabel[dIdx]
+                    if dEmbeddings is not None:
+                        self._tracks.SetEmbedding(currtIndex, dFeaturesCurrLabel[dIdx])
+                    elif self._appearanceManager is not None and \
+                            dFeaturesCurrLabel[dIdx].isSuccessful and \
+                            self._appearanceManager.IsTemplateDue(
+                                self._tracks, currtIndex):
+                        # Refresh the stale template of the track
+                        self._tracks.features[currtIndex] = dFeaturesCurrLabel[dIdx]
+                        self._tracks.templateAges[currtIndex] = 0
+                    self._tracks.lives[currtIndex] =+ self.UpdateLifeIndex(
+                        self._tracks.lives[currtIndex], True
                     )
                 if currClassRes == MatchClassification.OCCLUSION:
                     currtIndex = tCurrLabelIndexes[currCorrespondIndex]
@@ -127,32 +187,49 @@ class MultiObjectTracker():
                     currtUpdated[currtIndex] = True
                     pass
                 if currClassRes == MatchClassification.NEW_MATCH:
-                    # print("Inserting new tracked object...")
-                    currtIndex = self.InsertNewTrackedObject(
-                        dBoxesCurrLabel[dIdx], l, dFeaturesCurrLabel[dIdx]
-                    )
-                    currtUpdated[currtIndex] = True
+                    newMatches.append(
+                        (dBoxesCurrLabel[dIdx], l, dFeaturesCurrLabel[dIdx]))
+
+        # Insert new matches. Tracks updated in this frame are protected
+        # from eviction unless unavoidable
+        for box, l, features in newMatches:
+            # print("Inserting new tracked object...")
+            if dEmbeddings is not None:
+                currtIndex = self.InsertNewTrackedObject(
+                    box, l, None, currtUpdated
+                )
+                self._tracks.SetEmbedding(currtIndex, features)
+            else:
+                currtIndex = self.InsertNewTrackedObject(
+                    box, l, features, currtUpdated
+                )
+            if currtIndex >= len(currtUpdated):
+                # Track store capacity has grown
+                currtUpdated = np.concatenate((currtUpdated, np.zeros(
+                    self._tracks.GetCapacity() - len(currtUpdated),
+                    dtype=bool)))
+            currtUpdated[currtIndex] = True
 
         # For all others which have not been updated, propagate by
         # movement vector and also decrease life integer by one, down to min
         currtNotUpdated = currtUpdated == False
-        self._bboxes[currtNotUpdated] = self.GetPredictedPosition(
-            self._bboxes[currtNotUpdated], self._movementVecs[currtNotUpdated]
+        self._tracks.bboxes[currtNotUpdated] = self.GetPredictedPosition(
+            self._tracks.bboxes[currtNotUpdated], self._tracks.movementVecs[currtNotUpdated]
         )
-        self._lives[currtNotUpdated] = self.UpdateLifeIndex(
-            self._lives[currtNotUpdated], False
+        self._tracks.lives[currtNotUpdated] = self.UpdateLifeIndex(
+            self._tracks.lives[currtNotUpdated], False
         )
 
         # Cleanup those which have min life
-        self._trackingIDs[self._lives == self._minLife] = 0 
+        self._tracks.ReleaseDead()
 
         #self.PrintStatus()
 
 
     def ExtractFeatures(self, image : np.ndarray, bboxes : np.ndarray) -> np.ndarray:        
-        features = np.ndarray(bboxes.shape[0], dtype=FeatureExtractorORB)
+        features = np.ndarray(len(bboxes), dtype=FeatureExtractorORB)
 
-        for i in range(bboxes.shape[0]):
+        for i in range(len(bboxes)):
             patch = BoundingBox.GetImagePatch(bboxes[i],image)
             features[i] = FeatureExtractorORB()
             features[i].ComputeFeatures(patch)
@@ -179,6 +256,9 @@ class MultiObjectTracker():
         return distancesMatrix
     
     def ComputeFeatureDiffMatrix(self, featuresA : np.ndarray, featuresB : np.ndarray):
+        # Embeddings are given as 2D arrays, ORB features as 1D object arrays
+        if featuresA.ndim == 2:
+            return self.ComputeEmbeddingDiffMatrix(featuresA, featuresB)
         featureDiffMatrix = np.ndarray((featuresA.shape[0], featuresB.shape[0]))
         for i in range(len(featuresA)):
             for j in range(len(featuresB)):
@@ -189,27 +269,34 @@ class MultiObjectTracker():
                 featureDiffMatrix[i,j] = featureMatcher.GetMatchingLoss()
         # print(featureDiffMatrix)
         return featureDiffMatrix
+
+    def ComputeEmbeddingDiffMatrix(self, embeddingsA : np.ndarray,
+                                   embeddingsB : np.ndarray):
+        # Embeddings are L2 normalized, so cosine similarities of all pairs
+        # are given by a single matrix product
+        similarityMatrix = embeddingsA @ embeddingsB.T
+        return (1.0 - similarityMatrix) * self._embeddingDistanceScale
         
 
     def InsertNewTrackedObject(self, box : np.ndarray, label : int, 
-                                features : np.ndarray) -> int:
-        # Check if space is present for inserting a tracking object
-        maskAvailable = self._lives == 0
-        currIndex = GetNthOccurenceIndex(maskAvailable, 0)
-
-        if(currIndex >= 0):
-            # Space is available for tracking one more object
-            self._bboxes[currIndex] = box
-            self._labels[currIndex] = label
-            self._features[currIndex] = features
-            self._movementVecs[currIndex] = np.zeros(2)
-            self._trackingIDs[currIndex] = self.GetNextUniqueTrackID()
-            self._lives[currIndex] = self._minLife + 1
+                                features : np.ndarray,
+                                protectedMask : np.ndarray = None) -> int:
+        # Get a free slot, which also assigns a new unique tracking ID.
+        # Tracks in protectedMask (already updated in this frame) are not
+        # evicted unless unavoidable
+        currIndex = self._tracks.Allocate(protectedMask)
+
+        self._tracks.bboxes[currIndex] = box
+        self._tracks.labels[currIndex] = label
+        self._tracks.features[currIndex] = features \
+            if features is not None else FeatureExtractorORB()
+        self._tracks.movementVecs[currIndex] = np.zeros(2)
+        self._tracks.lives[currIndex] = self._minLife + 1
         return currIndex
 
-    def GetNextUniqueTrackID(self) -> int:
-        # Tracking ID is unique because always incremental
-        return np.max(self._trackingIDs) + 1
+    def GetLastDetectedFeatures(self) -> np.ndarray:
+        '''Get features of the detections passed to the last Update call'''
+        return self._lastDetectedFeatures
 
     # Get min index of a single slice
     def GetDetectedMatchClassification(self, slice : np.ndarray) -> np.ndarray:
@@ -242,26 +329,26 @@ class MultiObjectTracker():
     def PrintStatus(self) -> None:
         print('== TRACKED OBJECTS ==')
         print('Boxes:')
-        print(self._bboxes)
+        print(self._tracks.bboxes)
         print('Classes:')
-        print(self._labels)
+        print(self._tracks.labels)
         print('Features:')
-        print(self._features)
+        print(self._tracks.features)
         print('Movement vectors:')
-        print(self._movementVecs)
+        print(self._tracks.movementVecs)
         print('Tracking IDs:')
-        print(self._trackingIDs)
+        print(self._tracks.trackingIDs)
         print('Lives:')
-        print(self._lives)
+        print(self._tracks.lives)
         print('===================')
 
     def GetTrackedObjects(self, minLife = 3) -> dict:
         
-        selectionMask = self._lives >= minLife
+        selectionMask = self._tracks.lives >= minLife
 
-        bboxes = self._bboxes[selectionMask]
-        labels = self._labels[selectionMask]
-        ids = self._trackingIDs[selectionMask]
+        bboxes = self._tracks.bboxes[selectionMask]
+        labels = self._tracks.labels[selectionMask]
+        ids = self._tracks.trackingIDs[selectionMask]
 
         trackedPredictions = {
             'boxes': bboxes,
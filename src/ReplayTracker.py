@@ -0,0 +1,149 @@
+# Date:     2026-10-19
+# Author:   Massimo Clementi <massimo_clementi@icloud.com>
+# Topic:    Replay a recorded detection log through the multiobject tracker,
+#           with no detection model in the loop, and sweep the tracker
+#           parameters over a grid
+
+import argparse
+import itertools
+import json
+import time
+import numpy as np
+from DetectionLog import DetectionLogReader
+from MultiObjectTracker import MultiObjectTracker
+from AppearanceManager import AppearanceManager
+from FeatureExtractors import FeatureExtractor, FeatureExtractorORB
+
+
+class DetectionLogReplay():
+    '''Feed the detections of a memory-mapped log to a tracker'''
+
+    def __init__(self, path : str) -> None:
+        self._reader = DetectionLogReader(path)
+        assert self._reader.HasDescriptors() or self._reader.HasEmbeddings(), \
+            'Detection log was recorded without ORB descriptors nor embeddings'
+        # Feature extractors only reference the memory-mapped descriptors,
+        # thus they are built once and shared between replays
+        self._features = [None] * self._reader.GetNumFrames()
+
+    def GetReader(self) -> DetectionLogReader:
+        return self._reader
+
+    def _GetFeatures(self, idx : int) -> np.ndarray:
+        if self._features[idx] is None:
+            descriptors = self._reader.GetDescriptors(idx)
+            features = np.ndarray(len(descriptors), dtype=FeatureExtractor)
+            for i, d in enumerate(descriptors):
+                features[i] = FeatureExtractorORB()
+                features[i].SetFeatures(d)
+            self._features[idx] = features
+        return self._features[idx]
+
+    def Run(self, tracker : MultiObjectTracker, minLife = 3):
+        '''Generator yielding frame number and tracked objects of each
+        replayed frame'''
+        for idx in range(self._reader.GetNumFrames()):
+            detections = self._reader.GetDetections(idx)
+            # Logs recorded with detector embeddings are replayed with them
+            if self._reader.HasEmbeddings():
+                tracker.Update(
+                    None,
+                    detections['boxes'],
+                    detections['labels'],
+                    dEmbeddings=self._reader.GetEmbeddings(idx)
+                )
+            else:
+                tracker.Update(
+                    None,
+                    detections['boxes'],
+                    detections['labels'],
+                    dFeatures=self._GetFeatures(idx)
+                )
+            yield self._reader.GetFrameNumber(idx), \
+                tracker.GetTrackedObjects(minLife=minLife)
+
+
+def EvaluateParameters(replay : DetectionLogReplay, params : dict,
+                       maxNumTrackedObjects : int, minLife : int,
+                       refreshInterval : int = None) -> dict:
+    '''Replay the whole log with the given tracker parameters and collect
+    summary statistics of the resulting tracks. The tracker uses an
+    appearance manager if the log was recorded with one, as some detections
+    have no descriptors, with the recorded settings unless refreshInterval
+    is given'''
+    settings = replay.GetReader().GetAppearanceSettings()
+    if refreshInterval is not None:
+        settings = dict(settings or {}, refreshInterval=refreshInterval)
+    appearanceManager = AppearanceManager(**settings) \
+        if settings is not None else None
+    tracker = MultiObjectTracker(maxNumTrackedObjects=maxNumTrackedObjects,
+                                 appearanceManager=appearanceManager,
+                                 **params)
+    start = time.perf_counter()
+    trackLengths = {}
+    numFrames = 0
+    numTracked = 0
+    for _, tracked in replay.Run(tracker, minLife=minLife):
+        numFrames += 1
+        numTracked += len(tracked['ids'])
+        for id in tracked['ids']:
+            trackLengths[int(id)] = trackLengths.get(int(id), 0) + 1
+    elapsed = time.perf_counter() - start
+
+    lengths = np.array(list(trackLengths.values()))
+    return {
+        'params': params,
+        'numFrames': numFrames,
+        'numUniqueIDs': len(trackLengths),
+        'meanTrackedPerFrame': numTracked / max(1, numFrames),
+        'meanTrackLength': float(np.mean(lengths)) if len(lengths) else 0.0,
+        'replaySeconds': elapsed
+    }
+
+
+def ParseGrid(values : str) -> list:
+    return [float(v) for v in values.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Sweep tracker parameters over a recorded detection log')
+    parser.add_argument('log', help='path of the detection log')
+    parser.add_argument('--correspondenceMaxDistance', default='50',
+                        help='comma separated values')
+    parser.add_argument('--occlusionMinDistance', default='20',
+                        help='comma separated values')
+    parser.add_argument('--distanceFeaturesWeightFactor', default='0.5',
+                        help='comma separated values')
+    parser.add_argument('--maxNumTrackedObjects', type=int, default=150)
+    parser.add_argument('--minLife', type=int, default=3)
+    parser.add_argument('--refreshInterval', type=int, default=None,
+                        help='template refresh interval of the appearance '
+                             'manager, in frames (default: as recorded in '
+                             'the log, no manager if none was used)')
+    parser.add_argument('--output', default=None,
+                        help='write results as JSON to this path')
+    args = parser.parse_args()
+
+    replay = DetectionLogReplay(args.log)
+    grid = itertools.product(
+        ParseGrid(args.correspondenceMaxDistance),
+        ParseGrid(args.occlusionMinDistance),
+        ParseGrid(args.distanceFeaturesWeightFactor)
+    )
+
+    results = []
+    for c, o, w in grid:
+        params = {
+            'correspondenceMaxDistance': c,
+            'occlusionMinDistance': o,
+            'distanceFeaturesWeightFactor': w
+        }
+        results.append(EvaluateParameters(
+            replay, params, args.maxNumTrackedObjects, args.minLife,
+            args.refreshInterval))
+
+    print(json.dumps(results, indent=2))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
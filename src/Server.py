@@ -2,13 +2,46 @@
 # Author:   Massimo Clementi <massimo_clementi@icloud.com>
 # Topic:    Website that manages API calls
 
-from flask import Flask, jsonify, request
+import os
+import threading
+from collections import OrderedDict
+from flask import Flask, abort, jsonify, request
 import numpy as np
-from EncoderDecoder import EncoderDecoderNumpy, EncoderDecoderImage
-from CoreEngine import MyObjectDetector
+from EncoderDecoder import EncoderDecoderNumpy, EncoderDecoderImage, \
+                           EncoderDecoderNumpyBinary
+from DetectorVariants import DetectorVariantSelector, ParseVariants
+from SharedMemoryTransport import SharedMemoryServer
 
 app = Flask(__name__)
-objectDetector = MyObjectDetector()
+
+# Latency budget applied when not given by request or session
+defaultLatencyBudgetMs = os.environ.get('TRIP_LATENCY_BUDGET_MS')
+if defaultLatencyBudgetMs is not None:
+    defaultLatencyBudgetMs = float(defaultLatencyBudgetMs)
+
+# Detector variants, from the most accurate to the fastest. Without a
+# default latency budget only the most accurate one is hosted, unless
+# variants are given explicitly (e.g. for budgets given by requests)
+defaultDetectorVariants = 'fasterrcnn_mobilenet_v3_large_fpn'
+if defaultLatencyBudgetMs is not None:
+    defaultDetectorVariants += ',fasterrcnn_mobilenet_v3_large_fpn:512' \
+                               ',fasterrcnn_mobilenet_v3_large_320_fpn'
+detectorSelector = DetectorVariantSelector(
+    ParseVariants(os.environ.get('TRIP_DETECTOR_VARIANTS',
+                                 defaultDetectorVariants)),
+    backend=os.environ.get('TRIP_DETECTOR_BACKEND', 'eager'),
+    precision=os.environ.get('TRIP_DETECTOR_PRECISION', 'float32')
+)
+
+# Tiles of high resolution images requested with tiling are detected in
+# batches of this size, which bounds the peak memory of a request
+tileBatchSize = int(os.environ.get('TRIP_TILE_BATCH_SIZE', 4))
+
+# Latency budgets of sessions, by session ID. Session IDs are given by
+# clients, thus only the most recently used ones are remembered
+sessionLatencyBudgets = OrderedDict()
+sessionLatencyBudgetsLock = threading.Lock()
+maxNumSessions = int(os.environ.get('TRIP_MAX_SESSIONS', 1024))
 
 
 # Return server status and features
@@ -17,7 +50,8 @@ def EndpointServerStatus():
     response = {
         'running': True,
         'supportedAPIs': GetSupportedAPIVersions(),
-        'description': 'TRIP Vision Perception elaboration server'
+        'description': 'TRIP Vision Perception elaboration server',
+        'detectorVariants': detectorSelector.GetStatus()
     }
     return response
 
@@ -25,14 +59,85 @@ def GetSupportedAPIVersions():
     versions = ['v1.0']
     return versions
 
+def GetLatencyBudget(req : dict) -> float:
+    '''Get latency budget of the request. A budget given together with a
+    session ID is remembered and applied to later requests of the session'''
+    sessionID = req.get('sessionID')
+    if 'latencyBudgetMs' in req:
+        budget = req['latencyBudgetMs']
+        if sessionID is not None:
+            with sessionLatencyBudgetsLock:
+                sessionLatencyBudgets[sessionID] = budget
+                sessionLatencyBudgets.move_to_end(sessionID)
+                # Forget the least recently used sessions
+                while len(sessionLatencyBudgets) > maxNumSessions:
+                    sessionLatencyBudgets.popitem(last=False)
+        return budget
+    with sessionLatencyBudgetsLock:
+        if sessionID in sessionLatencyBudgets:
+            sessionLatencyBudgets.move_to_end(sessionID)
+            return sessionLatencyBudgets[sessionID]
+    return defaultLatencyBudgetMs
+
+def IsNumber(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def ValidateDetectObjectsRequest(req) -> str:
+    '''Get the error of a malformed request, None if it is valid'''
+    if not isinstance(req, dict) or not isinstance(req.get('image'), str):
+        return 'Missing image'
+    if 'minScore' in req and not IsNumber(req['minScore']):
+        return 'Invalid minScore'
+    if req.get('latencyBudgetMs') is not None and \
+            not IsNumber(req['latencyBudgetMs']):
+        return 'Invalid latencyBudgetMs'
+    if req.get('embeddings') not in (None, 'float16', 'int8'):
+        return 'Invalid embeddings, must be float16 or int8'
+    if 'tileSize' in req:
+        tileSize = req['tileSize']
+        overlap = req.get('tileOverlap', 128)
+        if not isinstance(tileSize, int) or tileSize <= 0:
+            return 'Invalid tileSize'
+        if not isinstance(overlap, int) or not 0 <= overlap < tileSize:
+            return 'Invalid tileOverlap, must be in [0, tileSize)'
+    return None
+
 @app.route('/api/v1.0/detectobjects', methods=['POST'])
 def EndpointDetectObjects():
-    req = request.get_json()
+    # Malformed requests are rejected as client errors (400), so that
+    # clients do not take them for server failures
+    req = request.get_json(silent=True)
+    error = ValidateDetectObjectsRequest(req)
+    if error is not None:
+        abort(400, description=error)
 
     imageEncoded = req['image']
-    image = EncoderDecoderImage().Decode(imageEncoded, np.uint8)
+    try:
+        image = EncoderDecoderImage().Decode(imageEncoded, np.uint8)
+    except Exception:
+        # Invalid base64 or image data
+        image = None
+    if image is None:
+        abort(400, description='Cannot decode image')
 
-    predictions = objectDetector.Detect(np.array([image]), minScore=0.8)
+    if 'tileSize' in req:
+        # High resolution image, detected in overlapping tiles
+        predictions, variantName = detectorSelector.DetectTiled(
+            image,
+            minScore=req.get('minScore', 0.8),
+            tileSize=req['tileSize'],
+            overlap=req.get('tileOverlap', 128),
+            batchSize=tileBatchSize,
+            embeddingsType=req.get('embeddings')
+        )
+    else:
+        # Add batch dimension as a view, without copying the image
+        predictions, variantName = detectorSelector.Detect(
+            image[np.newaxis],
+            minScore=req.get('minScore', 0.8),
+            latencyBudgetMs=GetLatencyBudget(req),
+            embeddingsType=req.get('embeddings')
+        )
 
     response = []
     for p in predictions:
@@ -41,15 +146,33 @@ def EndpointDetectObjects():
             'labels': EncoderDecoderNumpy().Encode(p['labels'], np.float32),
             'scores': EncoderDecoderNumpy().Encode(p['scores'], np.float32)
         })
+        if 'embeddings' in p:
+            response[-1]['embeddings'] = EncoderDecoderNumpyBinary().Encode(
+                p['embeddings'], p['embeddings'].dtype)
 
-    return response
+    return response, {'X-Detector-Variant': variantName}
 
 
 if __name__ == '__main__':
  
-    # Initialize ObjectDetector beforehand
-    objectDetector.CreateDNNModel()
+    # Initialize all detector variants beforehand
+    detectorSelector.CreateDNNModels()
+
+    # Serve co-located clients through shared memory, if enabled. Messages
+    # are pickled, thus the listener only accepts local connections and a
+    # secret authentication key is required
+    if 'TRIP_SHM_PORT' in os.environ:
+        assert os.environ.get('TRIP_SHM_AUTHKEY'), \
+            'TRIP_SHM_AUTHKEY is required by the shared memory transport'
+        SharedMemoryServer(
+            lambda images, minScore, latencyBudgetMs: detectorSelector.Detect(
+                images, minScore,
+                latencyBudgetMs if latencyBudgetMs is not None
+                else defaultLatencyBudgetMs)[0],
+            ('127.0.0.1', int(os.environ['TRIP_SHM_PORT'])),
+            os.environ['TRIP_SHM_AUTHKEY'].encode('utf-8')
+        ).Start()
 
     # run() method of Flask class runs the application 
     # on the local development server.
-    app.run(host='0.0.0.0')
+    app.run(host='0.0.0.0', port=int(os.environ.get('TRIP_SERVER_PORT', 5000)))
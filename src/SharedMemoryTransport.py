@@ -0,0 +1,261 @@
+# Date:     2026-10-19
+# Author:   Massimo Clementi <massimo_clementi@icloud.com>
+# Topic:    Zero-copy transport of frames and results between a client and a
+#           server running on the same host. Frames and results are placed
+#           in shared memory ring buffers, while only slot indexes and
+#           metadata are exchanged over a local connection
+
+import itertools
+import queue
+import sys
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from multiprocessing import connection, resource_tracker, shared_memory
+import numpy as np
+from Utilities import print_execution_time
+
+# Each result row is (c1, r1, c2, r2, label, score)
+_RESULT_ROW_SIZE = 6
+
+
+class SharedMemoryRing():
+    '''Ring of fixed size slots in a shared memory block'''
+
+    def __init__(self, numSlots : int, slotSize : int, name : str = None) -> None:
+        '''Create a new ring, or attach to the existing one with given name'''
+        self.numSlots = numSlots
+        self.slotSize = slotSize
+        if name is None:
+            self._shm = shared_memory.SharedMemory(
+                create=True, size=numSlots * slotSize)
+            self._isOwner = True
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+            self._isOwner = False
+            # Before Python 3.13 attached blocks are also tracked, and they
+            # would be unlinked when this process exits, while the creator
+            # still uses them
+            if sys.version_info < (3, 13):
+                resource_tracker.unregister(self._shm._name, 'shared_memory')
+        self.name = self._shm.name
+
+    def GetSlotView(self, slot : int, shape : tuple, dtype : type) -> np.ndarray:
+        '''Get a numpy array on the slot memory, without copying'''
+        dtype = np.dtype(dtype)
+        assert int(np.prod(shape)) * dtype.itemsize <= self.slotSize, \
+            'Data does not fit in a shared memory slot'
+        return np.ndarray(shape, dtype=dtype, buffer=self._shm.buf,
+                          offset=slot * self.slotSize)
+
+    def Close(self) -> None:
+        self._shm.close()
+        if self._isOwner:
+            self._shm.unlink()
+
+
+class SharedMemoryAPIs_v1():
+    '''Client of the shared memory transport, with the same DetectObjects
+    interface of RESTAPIs_v1. It can be used from several threads, with
+    up to numSlots frames in flight'''
+
+    def __init__(self, address : tuple, authkey : bytes, numSlots = 4,
+                 maxFrameBytes = 1920 * 1080 * 3, maxResults = 1024,
+                 timeout = 10.0) -> None:
+        '''Requests not answered within timeout seconds raise TimeoutError'''
+        print('Connecting to shared memory server at', address, '...')
+        self._timeout = timeout
+        self._frames = SharedMemoryRing(numSlots, maxFrameBytes)
+        self._results = SharedMemoryRing(
+            numSlots, maxResults * _RESULT_ROW_SIZE * np.dtype(np.float32).itemsize)
+        self._maxResults = maxResults
+        self._freeSlots = queue.Queue()
+        for slot in range(numSlots):
+            self._freeSlots.put(slot)
+
+        self._conn = connection.Client(address, authkey=authkey)
+        self._conn.send({
+            'op': 'attach',
+            'frames': (self._frames.name, numSlots, maxFrameBytes),
+            'results': (self._results.name, numSlots, self._results.slotSize)
+        })
+        assert self._conn.recv()['ok']
+
+        # Replies are dispatched to the waiting requests by a receiver
+        # thread. Pending requests are (future, slot) by request ID
+        self._requestIDs = itertools.count()
+        self._pending = {}
+        self._isConnected = True
+        self._sendLock = threading.Lock()
+        self._receiver = threading.Thread(target=self._ReceiveLoop, daemon=True)
+        self._receiver.start()
+
+    def _ReceiveLoop(self) -> None:
+        try:
+            while True:
+                reply = self._conn.recv()
+                # Resolved under lock, since timed out requests cancel
+                # their future under lock
+                with self._sendLock:
+                    future, slot = self._pending.pop(reply['id'])
+                    if future.cancelled():
+                        # The request timed out, its slot is free only now
+                        # that the server is done with it
+                        self._freeSlots.put(slot)
+                    elif 'error' in reply:
+                        future.set_exception(RuntimeError(
+                            'Shared memory server error: ' + reply['error']))
+                    else:
+                        future.set_result(reply)
+        except (EOFError, OSError) as e:
+            # Fail pending and later requests, instead of waiting forever
+            with self._sendLock:
+                self._isConnected = False
+                for future, _ in self._pending.values():
+                    if not future.cancelled():
+                        future.set_exception(ConnectionError(e))
+                self._pending.clear()
+
+    @print_execution_time
+    def DetectObjects(self, image : np.array, latencyBudgetMs : float = None,
+                      minScore : float = None, embeddingsType : str = None):
+        '''Detect objects on the image using FasterRCNN model'''
+        assert embeddingsType is None, \
+            'Embeddings are not supported by the shared memory transport'
+        try:
+            slot = self._freeSlots.get(timeout=self._timeout)
+        except queue.Empty:
+            raise TimeoutError('No free shared memory slot')
+        isSlotInUse = False
+        try:
+            # Single copy of the frame, into shared memory
+            self._frames.GetSlotView(slot, image.shape, image.dtype)[...] = image
+
+            future = Future()
+            with self._sendLock:
+                if not self._isConnected:
+                    raise ConnectionError('Shared memory server disconnected')
+                requestID = next(self._requestIDs)
+                self._pending[requestID] = (future, slot)
+                try:
+                    self._conn.send({
+                        'op': 'detect',
+                        'id': requestID,
+                        'slot': slot,
+                        'shape': image.shape,
+                        'dtype': image.dtype.str,
+                        'latencyBudgetMs': latencyBudgetMs,
+                        'minScore': minScore
+                    })
+                except OSError:
+                    del self._pending[requestID]
+                    raise
+            try:
+                reply = future.result(timeout=self._timeout)
+            except FutureTimeoutError:
+                # The server may still write results into the slot, which
+                # is given back by the receiver when the reply arrives
+                with self._sendLock:
+                    isSlotInUse = future.cancel()
+                if isSlotInUse:
+                    raise TimeoutError('Shared memory request timed out')
+                reply = future.result()
+
+            rows = np.array(self._results.GetSlotView(
+                slot, (reply['count'], _RESULT_ROW_SIZE), np.float32))
+        finally:
+            if not isSlotInUse:
+                self._freeSlots.put(slot)
+
+        if reply['truncated']:
+            print('Warning: results truncated to', self._maxResults, 'objects')
+        return [{
+            'boxes': rows[:, :4],
+            'labels': rows[:, 4],
+            'scores': rows[:, 5]
+        }]
+
+    def Close(self) -> None:
+        print('Closing shared memory transport...')
+        try:
+            with self._sendLock:
+                self._conn.send({'op': 'detach'})
+        except OSError:
+            pass
+        self._conn.close()
+        self._frames.Close()
+        self._results.Close()
+
+
+class SharedMemoryServer():
+    '''Serve detection requests of co-located clients. Frames are read in
+    place from the clients shared memory, results are written back in it'''
+
+    def __init__(self, detect, address : tuple, authkey : bytes) -> None:
+        '''The detect function is called as detect(images, minScore,
+        latencyBudgetMs) and returns the list of predictions'''
+        self._detect = detect
+        self._address = address
+        self._authkey = authkey
+
+    def Start(self) -> None:
+        '''Start accepting clients in a background thread'''
+        print('Starting shared memory server at', self._address, '...')
+        self._listener = connection.Listener(self._address, authkey=self._authkey)
+        threading.Thread(target=self._AcceptLoop, daemon=True).start()
+
+    def _AcceptLoop(self) -> None:
+        while True:
+            try:
+                conn = self._listener.accept()
+            except connection.AuthenticationError as e:
+                print('Shared memory client rejected:', e)
+                continue
+            threading.Thread(target=self._Serve, args=(conn,), daemon=True).start()
+
+    def _Serve(self, conn : connection.Connection) -> None:
+        frames = None
+        results = None
+        try:
+            while True:
+                msg = conn.recv()
+                if msg['op'] == 'attach':
+                    name, numSlots, slotSize = msg['frames']
+                    frames = SharedMemoryRing(numSlots, slotSize, name)
+                    name, numSlots, slotSize = msg['results']
+                    results = SharedMemoryRing(numSlots, slotSize, name)
+                    conn.send({'ok': True})
+                elif msg['op'] == 'detect':
+                    # A failing request must not close the connection
+                    try:
+                        reply = self._HandleDetect(msg, frames, results)
+                    except Exception as e:
+                        print('Shared memory request failed:', repr(e))
+                        reply = {'id': msg['id'], 'error': repr(e)}
+                    conn.send(reply)
+                elif msg['op'] == 'detach':
+                    break
+        except EOFError:
+            pass
+        finally:
+            conn.close()
+            if frames is not None: frames.Close()
+            if results is not None: results.Close()
+
+    def _HandleDetect(self, msg : dict, frames : SharedMemoryRing,
+                      results : SharedMemoryRing) -> dict:
+        slot = msg['slot']
+        image = frames.GetSlotView(slot, msg['shape'], msg['dtype'])
+        minScore = msg['minScore'] if msg['minScore'] is not None else 0.8
+        p = self._detect(image[np.newaxis], minScore, msg['latencyBudgetMs'])[0]
+
+        maxRows = results.slotSize // (_RESULT_ROW_SIZE * np.dtype(np.float32).itemsize)
+        count = min(len(p['boxes']), maxRows)
+        rows = results.GetSlotView(slot, (count, _RESULT_ROW_SIZE), np.float32)
+        rows[:, :4] = p['boxes'][:count]
+        rows[:, 4] = p['labels'][:count]
+        rows[:, 5] = p['scores'][:count]
+        return {
+            'id': msg['id'],
+            'count': count,
+            'truncated': count < len(p['boxes'])
+        }
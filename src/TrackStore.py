@@ -0,0 +1,120 @@
+# Date:     2026-10-19
+# Author:   Massimo Clementi <massimo_clementi@icloud.com>
+# Topic:    Storage of tracked objects as parallel arrays indexed by slot,
+#           with a free-list slot allocator and strictly monotonic IDs
+
+import numpy as np
+from FeatureExtractors import FeatureExtractor, FeatureExtractorORB
+
+
+class TrackStore():
+
+    def __init__(self, capacity : int, minLife : int,
+                 capacityPolicy = 'grow') -> None:
+        '''Instantiate the store with the given initial capacity. When all
+        slots are in use, the 'grow' policy doubles the capacity, while the
+        'evict' policy frees the slot of the track with the lowest life'''
+        assert capacityPolicy in ('grow', 'evict')
+        self._minLife = minLife
+        self._capacityPolicy = capacityPolicy
+        self._capacity = 0
+        self._freeSlots = []
+        self._nextTrackID = np.int64(1)
+
+        self.bboxes = np.zeros((0, 4))
+        self.labels = np.zeros(0, dtype=int)
+        self.features = np.ndarray(0, dtype=FeatureExtractor)
+        self.movementVecs = np.zeros((0, 2))
+        self.trackingIDs = np.zeros(0, dtype=np.int64)
+        self.lives = np.zeros(0, dtype=int)
+        # Frames since the appearance template (features) was last set
+        self.templateAges = np.zeros(0, dtype=int)
+        # Appearance embeddings are allocated on first use, since their size
+        # is given by the detector
+        self.embeddings = None
+        self._isAllocated = np.zeros(0, dtype=bool)
+        self._Resize(max(1, capacity))
+
+    def GetCapacity(self) -> int:
+        return self._capacity
+
+    def GetNumAllocated(self) -> int:
+        return self._capacity - len(self._freeSlots)
+
+    def _Resize(self, capacity : int) -> None:
+        '''Extend all arrays to the new capacity, keeping current content'''
+        n = capacity - self._capacity
+        self.bboxes = np.concatenate((self.bboxes, np.zeros((n, 4))))
+        self.labels = np.concatenate((self.labels, np.zeros(n, dtype=int)))
+        features = np.ndarray(n, dtype=FeatureExtractor)
+        for i in range(n):
+            features[i] = FeatureExtractorORB()
+        self.features = np.concatenate((self.features, features))
+        self.movementVecs = np.concatenate((self.movementVecs, np.zeros((n, 2))))
+        self.trackingIDs = np.concatenate(
+            (self.trackingIDs, np.zeros(n, dtype=np.int64)))
+        self.lives = np.concatenate((self.lives, np.zeros(n, dtype=int)))
+        self.templateAges = np.concatenate(
+            (self.templateAges, np.zeros(n, dtype=int)))
+        self._isAllocated = np.concatenate(
+            (self._isAllocated, np.zeros(n, dtype=bool)))
+        if self.embeddings is not None:
+            self.embeddings = np.concatenate((self.embeddings, np.zeros(
+                (n, self.embeddings.shape[1]), dtype=np.float32)))
+        # Free slots are a stack, lowest indexes are handed out first
+        self._freeSlots = list(range(capacity - 1, self._capacity - 1, -1)) + \
+            self._freeSlots
+        self._capacity = capacity
+
+    def SetEmbedding(self, idx : int, embedding : np.ndarray) -> None:
+        if self.embeddings is None:
+            self.embeddings = np.zeros((self._capacity, len(embedding)),
+                                       dtype=np.float32)
+        self.embeddings[idx] = embedding
+
+    def GetEmbeddings(self, mask : np.ndarray, size : int) -> np.ndarray:
+        '''Get embeddings of the selected tracks. Tracks without embedding
+        have a zero vector, which is equally distant from all others'''
+        if self.embeddings is None:
+            return np.zeros((np.count_nonzero(mask), size), dtype=np.float32)
+        return self.embeddings[mask]
+
+    def _EvictLowestLife(self, protectedMask : np.ndarray) -> None:
+        '''Free the slot of the track with the lowest life, oldest first,
+        preferring tracks which are not protected. Only called when all
+        slots are allocated'''
+        protected = np.zeros(self._capacity, dtype=bool)
+        if protectedMask is not None:
+            protected[:len(protectedMask)] = protectedMask
+        idx = np.lexsort((self.trackingIDs, self.lives, protected))[0]
+        print('Track store full, evicting track', self.trackingIDs[idx])
+        self.Release(idx)
+
+    def Allocate(self, protectedMask : np.ndarray = None) -> int:
+        '''Get a free slot for a new track, with a new unique ID. Tracks
+        marked by protectedMask are not evicted unless unavoidable'''
+        if not self._freeSlots:
+            if self._capacityPolicy == 'grow':
+                self._Resize(2 * self._capacity)
+            else:
+                self._EvictLowestLife(protectedMask)
+        idx = self._freeSlots.pop()
+        self._isAllocated[idx] = True
+        self.trackingIDs[idx] = self._nextTrackID
+        self._nextTrackID += 1
+        self.templateAges[idx] = 0
+        return idx
+
+    def Release(self, idx : int) -> None:
+        '''Give back the slot of a track'''
+        assert self._isAllocated[idx]
+        self._isAllocated[idx] = False
+        self.trackingIDs[idx] = 0
+        self.lives[idx] = self._minLife
+        self._freeSlots.append(idx)
+
+    def ReleaseDead(self) -> None:
+        '''Give back the slots of all tracks which reached min life'''
+        for idx in np.flatnonzero(np.logical_and(
+                self._isAllocated, self.lives <= self._minLife)):
+            self.Release(idx)
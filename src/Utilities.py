@@ -3,6 +3,8 @@
 # Topic:    Utility functions and classes
 
 from functools import wraps
+import hashlib
+import os
 import numpy as np
 import time
 
@@ -30,4 +32,29 @@ def GetIndexesFromMask(mask : np.ndarray) -> np.ndarray:
     sequence = np.arange(len(mask))
     return sequence[mask]
 
+# Get SHA-256 hex digest of the content of a file. Digests are cached
+# until the file size or modification time change
+_fileHashCache = {}
+def GetFileHash(path : str, chunkSize = 1 << 20) -> str:
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _fileHashCache:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunkSize), b''):
+                h.update(chunk)
+        _fileHashCache[key] = h.hexdigest()
+    return _fileHashCache[key]
 
+# Quantize L2 normalized embeddings to a compact type ('float16' or 'int8')
+def QuantizeEmbeddings(embeddings : np.ndarray, dtype : str) -> np.ndarray:
+    if dtype == 'int8':
+        return np.round(np.clip(embeddings, -1, 1) * 127).astype(np.int8)
+    assert dtype == 'float16', 'Unsupported embeddings type: ' + dtype
+    return embeddings.astype(np.float16)
+
+# Convert quantized embeddings back to L2 normalized float32
+def DequantizeEmbeddings(embeddings : np.ndarray) -> np.ndarray:
+    embeddings = embeddings.astype(np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)